@@ -1,3 +1,5 @@
+import numpy as np
+
 class VariablesList:
     def __init__(self, variables_list):
         self._variables = variables_list
@@ -19,6 +21,32 @@ class VariablesList:
         if var.lower() in self._variables.keys():
             return self._variables[var.lower()][1]
 
+class GrowingArray:
+    def __init__(self, n_columns, capacity=64, dtype=np.float64):
+        self._data = np.empty((max(capacity, 1), n_columns), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+    def __getitem__(self, index):
+        return self.get_array()[index]
+
+    def append(self, row):
+        if self._size == self._data.shape[0]:
+            data = np.empty((2 * self._data.shape[0], self._data.shape[1]), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size] = row
+        self._size += 1
+    def get_array(self):
+        return self._data[:self._size]
+    def get_column(self, index):
+        return self._data[:self._size, index]
+    def get_capacity(self):
+        return self._data.shape[0]
+    def get_dtype(self):
+        return self._data.dtype
+
 def make_columns_file(list1, list2, column_name1, column_name2, file_name):
     if len(list1) != len(list2):
         print("Error: Lists must have the same length.")
@@ -1,4 +1,5 @@
 import math
+import bisect
 import pvt
 import ipr
 import common
@@ -351,13 +352,7 @@ class SubFlowElement:
         self._v = (self._v_in + self._v_out) / 2.
 
     def calculate_rhoo(self, p, t):
-        self.pvt.set_t(t)
-        self.pvt.set_p(p)
-        self.pvt.calculate_rs_Standing()
-        self.pvt.calculate_p_bubble_Standing()
-        self.pvt.calculate_co_bubble_Standing()
-        self.pvt.calculate_bo_bubble_Standing()
-        self.pvt.calculate_bo_Standing()
+        self.pvt.update_bo_Standing(p, t)
 
     def calculate_q_in(self):
         self.calculate_rhoo(self._p_in, self._t_in)
@@ -395,11 +390,7 @@ class SubFlowElement:
         self._v_out = 4 * self._m_rate / (self.pvt.get_rho() * math.pi * self._d ** 2)
 
     def calculate_uo(self, p, t):
-        self.pvt.set_t(t)
-        self.pvt.set_p(p)
-        self.pvt.calculate_rs_Standing()
-        self.pvt.calculate_uo_do_Standing()
-        self.pvt.calculate_uo_Standing()
+        self.pvt.update_uo_Standing(p, t)
 
     def calculate_Reynolds(self):
         self.calculate_uo(self._p, self._t)
@@ -681,6 +672,51 @@ class FlowElement(SubFlowElement):
         self.set_t_in(self._elements[0].get_t_in())
         self.set_q_in(self._elements[0].get_q_in())
 
+class VLPTable:
+
+    def __init__(self):
+        self._q = None
+        self._wfr = None
+        self._pwh = None
+        self._pwf = None
+
+    def get_q(self):
+        return self._q
+    def get_wfr(self):
+        return self._wfr
+    def get_pwh(self):
+        return self._pwh
+    def get_pwf_values(self):
+        return self._pwf
+
+    def set_values(self, q, wfr, pwh, pwf):
+        self._q = list(q)
+        self._wfr = list(wfr)
+        self._pwh = list(pwh)
+        self._pwf = pwf
+
+    def contains(self, q, wfr, pwh):
+        return (self._q[0] <= q <= self._q[-1]) and (self._wfr[0] <= wfr <= self._wfr[-1]) and (self._pwh[0] <= pwh <= self._pwh[-1])
+
+    def _locate(self, axis, x):
+        if len(axis) == 1:
+            return 0, 0, 0.
+        i = min(max(bisect.bisect_right(axis, x) - 1, 0), len(axis) - 2)
+        return i, i + 1, (x - axis[i]) / (axis[i+1] - axis[i])
+
+    def get_pwf(self, q, wfr, pwh):
+        i0, i1, wi = self._locate(self._q, q)
+        j0, j1, wj = self._locate(self._wfr, wfr)
+        k0, k1, wk = self._locate(self._pwh, pwh)
+        v = self._pwf
+        c00 = v[i0][j0][k0] + wk * (v[i0][j0][k1] - v[i0][j0][k0])
+        c01 = v[i0][j1][k0] + wk * (v[i0][j1][k1] - v[i0][j1][k0])
+        c10 = v[i1][j0][k0] + wk * (v[i1][j0][k1] - v[i1][j0][k0])
+        c11 = v[i1][j1][k0] + wk * (v[i1][j1][k1] - v[i1][j1][k0])
+        c0 = c00 + wj * (c01 - c00)
+        c1 = c10 + wj * (c11 - c10)
+        return c0 + wi * (c1 - c0)
+
 class CompositeFlowElement:
 
     def __init__(self, debug_mode=False):
@@ -690,6 +726,8 @@ class CompositeFlowElement:
         self.pvt = pvt.PVT()
         self.ipr = ipr.IPR()
         self._reservoir = None
+        self._best_state = None
+        self._best_n_eval = None
         self._dt = None
 
         self._p_in = None
@@ -715,6 +753,17 @@ class CompositeFlowElement:
         self._eps = 1E-12
         self._debug = debug_mode
 
+        self._root_methods = ['secant', 'bracket']
+        self._root_method = 'secant'
+        self._slope = None
+        self._n_eval = 0
+
+        self._vlp = None
+        self._vlp_tol = None
+        self._use_vlp = False
+        self._reservoir_response = False
+        self._use_reservoir_response = False
+
         self.variables = common.VariablesList({
             'elements':['List of FlowElements', '-'],
             'current element':['Current FlowElement', '-'],
@@ -739,6 +788,11 @@ class CompositeFlowElement:
             'ipr':['IPR object','-'],
             'pwf':['Bottom-hole pressure at the operational point','-'],
             'max_iter':['Maximum interations in operational point calculation','-'],
+            'root_method':['Method used in operational point calculation','-'],
+            'n_eval':['Function evaluations in the last operational point calculation','-'],
+            'vlp':['Vertical lift performance table','-'],
+            'reservoir_response':['Use linear reservoir response to Pwf in the operational point search','-'],
+            'vlp_tol':['Maximum Pwf error accepted from the VLP table and reservoir response','bar'],
             })
 
     def _log(self, message):
@@ -764,10 +818,24 @@ class CompositeFlowElement:
     def set_d(self,d):
         self._d = d
         self.pvt.set_d(d)
+    def set_d_elements(self,d):
+        self.set_d(d)
+        for element in self._elements:
+            element._d = d
+            element.pvt.set_d(d)
+        self.reset_vlp()
     def set_e(self,e):
         self._e = e
     def set_max_iter(self,i):
         self._max_iter = i
+    def set_root_method(self,method):
+        if method.lower() not in self._root_methods:
+            raise NameError(f'Unknown operational point method ({method}). Valid methods: {self._root_methods}.')
+        self._root_method = method.lower()
+    def get_root_method(self):
+        return self._root_method
+    def get_n_eval(self):
+        return self._n_eval
     def set_esp_dp(self,value):
         self._esp_dp = value
     def get_esp_dp(self):
@@ -775,6 +843,16 @@ class CompositeFlowElement:
 
     def set_dt(self,value):
         self._dt = value
+    def set_vlp_tol(self,value):
+        self._vlp_tol = value
+    def set_reservoir_response(self,value):
+        self._reservoir_response = value
+    def get_reservoir_response(self):
+        return self._reservoir_response
+    def get_vlp(self):
+        return self._vlp
+    def reset_vlp(self):
+        self._vlp = None
     def set_reservoir(self, reservoir_obj):
         self._reservoir = reservoir_obj
 
@@ -924,16 +1002,19 @@ class CompositeFlowElement:
         for element in self._elements:
             if isinstance(element, Esp):
                 element.set_eff(value)
+        self.reset_vlp()
 
     def set_esp_delta_p(self, value):
         for element in self._elements:
             if isinstance(element, Esp):
                 element.set_delta_p(value)
+        self.reset_vlp()
 
     def set_esp_eff_coef(self, value):
         for element in self._elements:
             if isinstance(element, Esp):
                 element.set_eff_coef(value)
+        self.reset_vlp()
 
     def get_esp_true_eff(self):
         for element in self._elements:
@@ -947,8 +1028,57 @@ class CompositeFlowElement:
                 return element.get_power()
         return 0.
 
+    def _keep_best(self):
+        self._best_n_eval = self._n_eval
+        if self._reservoir is not None:
+            self._best_state = self._reservoir.snapshot()
+
+    def _restore_best(self):
+        # the line holds the state of the last trial; solve it again when the best Pwf was an earlier one
+        state = self._best_state
+        self._best_state = None
+        if self._best_n_eval == self._n_eval:
+            return
+        if self._reservoir is None:
+            self.set_q_std(self.ipr.get_q(self._pwf))
+        else:
+            self._reservoir.restore(state)
+            qo_std, qw_std = state['rates']
+            self.set_q_std(qo_std + qw_std)
+            self.pvt.set_wfr(qw_std / (qo_std + qw_std))
+        self.solve_in_flow()
+
     def solve_reservoir(self, pwf):
-        return self._reservoir.try_pwf(pwf, self._dt)
+        if self._use_reservoir_response:
+            return self._reservoir.try_pwf_response(pwf, self._dt)
+        return self._reservoir.propose(pwf, self._dt)
+
+    def build_vlp(self, q_list, wfr_list, pwh_list):
+        p_out = self._p_out
+        q_std = self._q_std
+        wfr = self.pvt.get_wfr()
+        values = []
+        for q in q_list:
+            values.append([])
+            for w in wfr_list:
+                values[-1].append([])
+                for pwh in pwh_list:
+                    self.set_p_out(pwh)
+                    self.pvt.set_wfr(w)
+                    self.set_q_std(q)
+                    self.solve_in_flow()
+                    values[-1][-1].append(self.get_p_in()[0])
+        self._vlp = VLPTable()
+        self._vlp.set_values(q_list, wfr_list, pwh_list, values)
+        self.set_p_out(p_out)
+        self.set_q_std(q_std)
+        self.pvt.set_wfr(wfr)
+
+    def _solve_p_in(self):
+        if self._use_vlp and self._vlp.contains(self._q_std, self.pvt.get_wfr(), self._p_out):
+            return self._vlp.get_pwf(self._q_std, self.pvt.get_wfr(), self._p_out)
+        self.solve_in_flow()
+        return self.get_p_in()[0]
 
     def _pwf_error(self, pwf):
         if self._reservoir is None:
@@ -959,10 +1089,107 @@ class CompositeFlowElement:
             wfr = qw_std / q_std
             self.pvt.set_wfr(wfr)
         self.set_q_std(q_std)
-        self.solve_in_flow()
-        return pwf - self.get_p_in()[0]
+        self._n_eval += 1
+        return pwf - self._solve_p_in()
 
     def solve_operation_point(self, pwf_test=None):
+        self._n_eval = 0
+        use_response = self._reservoir_response and self._reservoir is not None
+        if self._vlp is None and not use_response:
+            self._solve_operation_point(pwf_test)
+            return
+        self._use_vlp = self._vlp is not None
+        self._use_reservoir_response = use_response
+        self._solve_operation_point(pwf_test)
+        self._use_vlp = False
+        self._use_reservoir_response = False
+        error = self._pwf_error(self._pwf)
+        self._log(f' Full calculation check: p={self._pwf}, f={error}')
+        if self._vlp_tol is not None and abs(error) > self._vlp_tol:
+            self._solve_operation_point(self._pwf)
+
+    def _solve_operation_point(self, pwf_test=None):
+        if self._root_method == 'bracket':
+            self._solve_operation_point_bracket(pwf_test)
+        else:
+            self._solve_operation_point_secant(pwf_test)
+
+    def _solve_operation_point_bracket(self, pwf_test=None):
+        self._log('Operation point search (bracket)')
+        if pwf_test is None:
+            p0 = self.ipr.get_pr() * 0.98
+        else:
+            p0 = pwf_test
+        f0 = self._pwf_error(p0)
+        self._log(f' i=0, p={p0}, f={f0}')
+        p_best = p0
+        f_best = abs(f0)
+        self._keep_best()
+        if f_best < self._eps:
+            self._pwf = p_best
+            return
+        if self._slope is not None and self._slope > 0.:
+            p1 = p0 - f0 / self._slope
+        elif pwf_test is None:
+            p1 = self.ipr.get_pr() * 0.96
+        else:
+            p1 = pwf_test * 0.95
+        if p1 <= 0.:
+            p1 = p0 * 0.5
+        f1 = self._pwf_error(p1)
+        self._log(f' i=1, p={p1}, f={f1}')
+        if abs(f1) < f_best:
+            p_best = p1
+            f_best = abs(f1)
+            self._keep_best()
+
+        bracket = None
+        if f0 * f1 < 0.:
+            bracket = [p0, f0, p1, f1]
+        side = 0
+        i = 0
+        while i < self._max_iter and f_best >= self._eps and abs(f1 - f0) > 1E-12:
+            self._slope = (f1 - f0) / (p1 - p0)
+            p2 = p1 - f1 / self._slope
+            if bracket is not None:
+                a, fa, b, fb = bracket
+                if not (min(a, b) < p2 < max(a, b)):
+                    p2 = (a * fb - b * fa) / (fb - fa)
+            elif p2 <= 0.:
+                p2 = p1 * 0.5
+            f2 = self._pwf_error(p2)
+            self._log(f' i={i+2}, p={p2}, f={f2}')
+            if abs(f2) < f_best:
+                p_best = p2
+                f_best = abs(f2)
+                self._keep_best()
+            if abs(p2 - p1) < self._eps:
+                break
+            if bracket is None:
+                if f1 * f2 < 0.:
+                    bracket = [p1, f1, p2, f2]
+            else:
+                if f2 * bracket[1] < 0.:
+                    bracket[2] = p2
+                    bracket[3] = f2
+                    if side == -1:
+                        bracket[1] /= 2.
+                    side = -1
+                else:
+                    bracket[0] = p2
+                    bracket[1] = f2
+                    if side == 1:
+                        bracket[3] /= 2.
+                    side = 1
+            p0 = p1
+            f0 = f1
+            p1 = p2
+            f1 = f2
+            i += 1
+        self._pwf = p_best
+        self._restore_best()
+
+    def _solve_operation_point_secant(self, pwf_test=None):
         self._log('Operation point search')
         if pwf_test is None:
             p0 = self.ipr.get_pr() * 0.98
@@ -970,6 +1197,7 @@ class CompositeFlowElement:
             p0 = pwf_test
         f0 = self._pwf_error(p0)
         self._log(f' i=0, p={p0}, f={f0}')
+        self._keep_best()
         if pwf_test is None:
             p1 = self.ipr.get_pr() * 0.96
         else:
@@ -981,6 +1209,7 @@ class CompositeFlowElement:
         if abs(f1) < f_best:
             p_best = p1
             f_best = abs(f1)
+            self._keep_best()
         i = 0
         while i < self._max_iter and (abs(f1 - f0) > 1E-12):
             p2 = p1 - f1 * (p1 - p0) / (f1 - f0)
@@ -989,6 +1218,7 @@ class CompositeFlowElement:
             if abs(f2) < f_best:
                 p_best = p2
                 f_best = abs(f2)
+                self._keep_best()
             if f_best < self._eps:
                 break
             if abs(p2 - p1) < self._eps:
@@ -999,3 +1229,4 @@ class CompositeFlowElement:
             f1 = f2
             i += 1
         self._pwf = p_best
+        self._restore_best()
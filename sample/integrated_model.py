@@ -1,3 +1,7 @@
+import copy
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import reservoir
 import pvt
 import flow
@@ -24,6 +28,10 @@ class Integration:
 
         self._gas_loss = 0.
 
+        self._vlp_q = None
+        self._vlp_wfr = None
+        self._vlp_pwh = None
+
         self._last_pwf = None
         self._dt = None
 
@@ -48,6 +56,10 @@ class Integration:
         self._total_emission = None
         self._cumulative_emission = None
         self._emission_boe = None
+        self._result_names = ['t', 'qo', 'qw', 'qg', 'qwi', 'pwf_prod', 'pwf_inj', 'pwh_prod', 'pwh_inj',
+                              'qg_flare', 'qg_fuel', 'qg_export', 'pump_power', 'esp_power', 'export_power',
+                              'total_power', 'gas_emission', 'diesel_emission', 'total_emission',
+                              'cumulative_emission', 'emission_boe']
 
         self._file_name = None
         self._file = None
@@ -72,9 +84,40 @@ class Integration:
         self._file_name = value
     def set_out_folder(self, value):
         self._out_folder = value
+    def set_vlp_range(self, q_list, wfr_list, pwh_list):
+        self._vlp_q = q_list
+        self._vlp_wfr = wfr_list
+        self._vlp_pwh = pwh_list
+
+    def set_overrides(self, overrides):
+        # names are setters, optionally prefixed by the attribute path: 'well_head_p', 'flow_prod.esp_delta_p'
+        for name, value in overrides.items():
+            *path, variable = name.split('.')
+            obj = self
+            for attribute in path:
+                obj = getattr(obj, attribute, None)
+                if obj is None:
+                    raise NameError(f'Unknown object ({attribute}) in override {name}.')
+            setter = getattr(obj, 'set_' + variable, None)
+            if setter is None:
+                raise NameError(f'Unknown setter (set_{variable}) in override {name}.')
+            setter(value)
+
+    def get_result_names(self):
+        return self._result_names
+
+    def get_results(self, names=None):
+        if names is None:
+            names = self._result_names
+        for name in names:
+            if name not in self._result_names:
+                raise NameError(f'Unknown result ({name}). Valid results: {self._result_names}.')
+        return {name: np.array(getattr(self, '_' + name), dtype=float) for name in names}
 
     def initialize(self):
-        if self._out_folder is None:
+        if self._file_name is None:
+            self._file = None
+        elif self._out_folder is None:
             self._file = open(self._file_name, 'w')
         else:
             self._file = open(self._out_folder + self._file_name, 'w')
@@ -100,6 +143,8 @@ class Integration:
         self.flow_prod.set_t_out(self._well_head_t)
         self.flow_prod.set_reservoir(self.reservoir)
         self.flow_prod.update_pvt()
+        if self._vlp_q is not None:
+            self.flow_prod.build_vlp(self._vlp_q, self._vlp_wfr, self._vlp_pwh)
 
         self.flow_inj.pvt = self.pvt.copy()
         self.flow_inj.pvt.set_wfr(1.)
@@ -134,37 +179,41 @@ class Integration:
         self._emission_boe = [0.]
 
     def advance_simulation(self, dt):
+        dt = self.reservoir.limit_dt(dt)
         self.flow_prod.set_dt(dt)
         self.flow_prod.solve_operation_point(self._last_pwf)
 
         while not self.reservoir.check_convergence(dt):
-            dt = max(dt / 2., self.reservoir.get_min_dt())
+            dt = max(self.reservoir.step_controller.reject(dt, self.reservoir.get_step_error()), self.reservoir.get_min_dt())
+            self.reservoir.rollback()
             if self._debug:
                 print(f" {self.reservoir.get_t()[-1]:10.2f} days: time-step cut. New dt = {dt:10.5f} days")
             self.flow_prod.set_dt(dt)
             self.flow_prod.solve_operation_point(self._last_pwf)
 
-        self.reservoir.run_simulation(dt, True)
+        error = self.reservoir.get_step_error()
+        self.reservoir.commit(dt)
         self._last_pwf = self.flow_prod.get_pwf()
         self._t = self.reservoir.get_t()
-        self._qo = self.reservoir.get_well_qo()
-        self._qw = self.reservoir.get_well_qw()
+        qo, qw = self.reservoir.get_last_well_rates()
+        self._qo.append(qo)
+        self._qw.append(qw)
         self._qwi.append(self.reservoir.get_qwi())
         self._pwf_prod.append(self.flow_prod.get_pwf())
         self._pwf_inj.append(self.reservoir.get_inj_pwf())
         self._pwh_prod.append(self.flow_prod.get_p_out()[-1])
         # pwf_flow = self.flow_prod.get_p_in()[0]
         # self._log(f' t = {self._t[-1]:0.2f} days, Pwf_prod = {self._pwf_prod[-1]:0.2f} bar, Qo = {self._qo[-1]:0.2f} m3/d, Qw = {self._qw[-1]:0.2f} m3/d, , Pwf_flow = {pwf_flow:0.2f} bar, Phead = {self._pwh_prod[-1]:0.2f} bar')
-        dt = min(dt * 1.2, self.reservoir.get_max_dt())
+        dt = min(self.reservoir.step_controller.accept(dt, error), self.reservoir.get_max_dt())
         # print(f" {self.reservoir.get_t()[-1]:10.2f} days: time-step advance. New dt = {dt:10.5f} days")
         return dt
 
-    def run_simulation(self, dt, make_plots=True):
+    def run_simulation(self, dt, make_plots=True, show_progress=True):
         self.initialize()
         t = 0.
         dti = dt
 
-        progress_bar = tqdm(total=100, desc="Progress", bar_format="{percentage:3.0f}% {elapsed} {bar}")
+        progress_bar = tqdm(total=100, desc="Progress", bar_format="{percentage:3.0f}% {elapsed} {bar}", disable=not show_progress)
         while t < self.reservoir.get_t_end():
             dti = min(dti, self.reservoir.get_t_end() - t)
             dti = self.advance_simulation(dti)
@@ -177,10 +226,12 @@ class Integration:
             percentage_completion = min(0.999, t / self.reservoir.get_t_end()) * 100
             progress_bar.update(percentage_completion - progress_bar.n)
         progress_bar.close()
-        self._file.close()
+        if self._file is not None:
+            self._file.close()
         if make_plots:
             self.make_all_plots()
-        print("End of simulation.")
+        if show_progress:
+            print("End of simulation.")
 
     def solve_water_injection(self):
         self.water_pump.set_qw(self._qwi[-1])
@@ -238,6 +289,8 @@ class Integration:
         self._emission_boe.append(self._total_emission[-1] / (self._qo[-1] + self._qg[-1]/1000.))
 
     def print_heading(self):
+        if self._file is None:
+            return
         s = f'{"Time_d":>25s}'
         s += f'\t{"TimeStep_d":>25s}'
         s += f'\t{"Qo_m3/d":>25s}'
@@ -263,6 +316,8 @@ class Integration:
         self._file.write(s + '\n')
 
     def print_results(self):
+        if self._file is None:
+            return
         s  =   f'{self._t[-1]:25.2f}'
         s += f'\t{self._t[-1]-self._t[-2]:25.2f}'
         s += f'\t{self._qo[-1]:25.2f}'
@@ -320,3 +375,73 @@ class Integration:
         self._simple_plot(self._t, [i/1000. for i in self._total_emission], "Time [d]", "", "TotalEmission [tonCO2/d]", "TotalEmission")
         self._simple_plot(self._t, [i/1000. for i in self._cumulative_emission], "Time [d]", "", "CumEmission [tonCO2]", "CumEmission")
         self._simple_plot(self._t, self._emission_boe, "Time [d]", "", "RelEmission [kgCO2/boe]", "RelEmission")
+
+
+_sweep_model = None
+
+def _init_sweep_worker(build_model):
+    # the base model is built once per worker; each scenario runs on a copy of it
+    global _sweep_model
+    _sweep_model = build_model()
+
+def _run_sweep_scenario(args):
+    overrides, dt, names = args
+    model = copy.deepcopy(_sweep_model)
+    model.set_file_name(None)
+    model.set_overrides(overrides)
+    model.run_simulation(dt, make_plots=False, show_progress=False)
+    return model.get_results(names)
+
+class ScenarioSweep:
+
+    def __init__(self, build_model):
+        self._build_model = build_model
+        self._scenarios = []
+        self._workers = None
+        self._names = ['t', 'qo', 'qw', 'qg', 'pwf_prod', 'pwf_inj', 'total_power', 'total_emission', 'cumulative_emission']
+
+    def set_workers(self, n):
+        self._workers = n
+    def set_result_names(self, names):
+        self._names = names
+    def add_scenario(self, overrides):
+        self._scenarios.append(dict(overrides))
+    def add_grid(self, values):
+        names = list(values.keys())
+        for combination in itertools.product(*[values[name] for name in names]):
+            self.add_scenario(dict(zip(names, combination)))
+    def reset_scenarios(self):
+        self._scenarios = []
+
+    def get_workers(self):
+        return self._workers
+    def get_result_names(self):
+        return self._names
+    def get_scenarios(self):
+        return self._scenarios
+
+    def run(self, dt):
+        if len(self._scenarios) == 0:
+            return {}
+        tasks = [(overrides, dt, self._names) for overrides in self._scenarios]
+        if self._workers == 1:
+            _init_sweep_worker(self._build_model)
+            results = [_run_sweep_scenario(task) for task in tqdm(tasks)]
+        else:
+            with ProcessPoolExecutor(max_workers=self._workers, initializer=_init_sweep_worker,
+                                     initargs=(self._build_model,)) as executor:
+                results = list(tqdm(executor.map(_run_sweep_scenario, tasks), total=len(tasks)))
+        return self._get_columns(results)
+
+    def _get_columns(self, results):
+        # one row per scenario and time-step; overrides are repeated on every row of their scenario
+        override_names = []
+        for overrides in self._scenarios:
+            override_names.extend(name for name in overrides if name not in override_names)
+        n_rows = [len(result[self._names[0]]) for result in results]
+        columns = {'scenario': np.repeat(np.arange(len(results)), n_rows)}
+        for name in override_names:
+            columns[name] = np.repeat([overrides.get(name, np.nan) for overrides in self._scenarios], n_rows)
+        for name in self._names:
+            columns[name] = np.concatenate([result[name] for result in results])
+        return columns
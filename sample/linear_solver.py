@@ -0,0 +1,308 @@
+import numpy as np
+import scipy.linalg as sla
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+import scipy.sparse.csgraph as csgraph
+
+class LinearSolver:
+
+    def __init__(self):
+        self._methods = ['dense', 'sparse', 'banded', 'gmres', 'bicgstab']
+        self._method = 'dense'
+
+        self._orderings = ['natural', 'rcm', 'grid']
+        self._ordering = 'natural'
+        self._grid_shape = None
+        self._perm = None
+        self._bandwidth = None
+
+        self._preconditioners = ['ilu', 'cpr']
+        self._preconditioner = 'ilu'
+        self._tol = 1e-10
+        self._max_krylov_iter = 500
+        self._restart = 50
+        self._max_reuse_iter = 20
+        self._ilu_drop_tol = 1e-4
+        self._ilu_fill_factor = 10.
+        self._block_size = 2
+        self._precond = None
+        self._precond_n = None
+        self._n_linear_iter = 0
+        self._n_failed = 0
+
+        self._pattern_rows = None
+        self._pattern_cols = None
+        self._pattern_map = None
+        self._pattern_indices = None
+        self._pattern_indptr = None
+        self._pattern_n = None
+
+        self._reuse = False
+        self._refinement_tol = 1e-10
+        self._max_refinement = 10
+        self._lu = None
+        self._lu_n = None
+        self._n_factorizations = 0
+        self._n_reused = 0
+
+    def set_method(self, method):
+        if method.lower() not in self._methods:
+            raise NameError(f'Unknown linear solver ({method}). Valid solvers: {self._methods}.')
+        self._method = method.lower()
+        self._pattern_rows = None
+        self._lu = None
+        self._precond = None
+
+    def get_method(self):
+        return self._method
+
+    def is_sparse(self):
+        return self._method != 'dense'
+
+    def is_krylov(self):
+        return self._method in ['gmres', 'bicgstab']
+
+    def set_ordering(self, ordering):
+        if ordering.lower() not in self._orderings:
+            raise NameError(f'Unknown ordering ({ordering}). Valid orderings: {self._orderings}.')
+        self._ordering = ordering.lower()
+        self._perm = None
+        self._lu = None
+        self._precond = None
+    def set_grid_shape(self, ni, nj, nk=1):
+        self._grid_shape = (ni, nj, nk)
+        self._perm = None
+
+    def get_ordering(self):
+        return self._ordering
+    def get_bandwidth(self):
+        return self._bandwidth
+
+    def set_preconditioner(self, preconditioner):
+        if preconditioner.lower() not in self._preconditioners:
+            raise NameError(f'Unknown preconditioner ({preconditioner}). Valid preconditioners: {self._preconditioners}.')
+        self._preconditioner = preconditioner.lower()
+        self._precond = None
+    def set_tol(self, value):
+        self._tol = value
+    def set_max_krylov_iter(self, value):
+        self._max_krylov_iter = value
+    def set_restart(self, value):
+        self._restart = value
+    def set_max_reuse_iter(self, value):
+        self._max_reuse_iter = value
+    def set_ilu_drop_tol(self, value):
+        self._ilu_drop_tol = value
+    def set_ilu_fill_factor(self, value):
+        self._ilu_fill_factor = value
+    def set_block_size(self, value):
+        self._block_size = value
+
+    def get_preconditioner(self):
+        return self._preconditioner
+    def get_tol(self):
+        return self._tol
+    def get_max_krylov_iter(self):
+        return self._max_krylov_iter
+    def get_n_linear_iter(self):
+        return self._n_linear_iter
+    def get_n_failed(self):
+        return self._n_failed
+
+    def set_reuse_factorization(self, value):
+        self._reuse = value
+        self._lu = None
+        self._precond = None
+    def set_refinement_tol(self, value):
+        self._refinement_tol = value
+    def set_max_refinement(self, value):
+        self._max_refinement = value
+
+    def get_reuse_factorization(self):
+        return self._reuse
+    def get_refinement_tol(self):
+        return self._refinement_tol
+    def get_max_refinement(self):
+        return self._max_refinement
+    def get_n_factorizations(self):
+        return self._n_factorizations
+    def get_n_reused(self):
+        return self._n_reused
+
+    def reset_counters(self):
+        self._n_factorizations = 0
+        self._n_reused = 0
+        self._n_linear_iter = 0
+        self._n_failed = 0
+
+    def _same_pattern(self, rows, cols, n):
+        return (self._pattern_rows is not None
+                and self._pattern_n == n
+                and np.array_equal(self._pattern_rows, rows)
+                and np.array_equal(self._pattern_cols, cols))
+
+    def _build_pattern(self, rows, cols, n):
+        a = sp.csc_matrix((np.ones(rows.size), (rows, cols)), shape=(n, n))
+        a.sum_duplicates()
+        a.sort_indices()
+        key = rows.astype(np.int64) + cols.astype(np.int64) * n
+        nz_key = a.indices.astype(np.int64) + np.repeat(np.arange(n, dtype=np.int64), np.diff(a.indptr)) * n
+        self._pattern_map = np.searchsorted(nz_key, key)
+        self._pattern_indices = a.indices.copy()
+        self._pattern_indptr = a.indptr.copy()
+        self._pattern_rows = rows.copy()
+        self._pattern_cols = cols.copy()
+        self._pattern_n = n
+        self._perm = None
+
+    def build_matrix(self, rows, cols, values, n):
+        rows = np.asarray(rows, dtype=int)
+        cols = np.asarray(cols, dtype=int)
+        values = np.asarray(values, dtype=float)
+        if self.is_sparse():
+            if not self._same_pattern(rows, cols, n):
+                self._build_pattern(rows, cols, n)
+            data = np.bincount(self._pattern_map, weights=values, minlength=self._pattern_indices.size)
+            return sp.csc_matrix((data, self._pattern_indices, self._pattern_indptr), shape=(n, n))
+        a = np.zeros((n, n))
+        np.add.at(a, (rows, cols), values)
+        return a
+
+    def _factorize(self, a):
+        self._n_factorizations += 1
+        if self.is_sparse():
+            self._lu = spla.splu(a)
+        else:
+            self._lu = sla.lu_factor(a)
+        self._lu_n = a.shape[0]
+
+    def _lu_solve(self, b):
+        if self.is_sparse():
+            return self._lu.solve(b)
+        return sla.lu_solve(self._lu, b)
+
+    def _refine(self, a, b):
+        x = self._lu_solve(b)
+        b_norm = np.linalg.norm(b)
+        for _ in range(self._max_refinement):
+            r = b - a.dot(x)
+            if np.linalg.norm(r) <= self._refinement_tol * b_norm:
+                return x
+            x = x + self._lu_solve(r)
+        return None
+
+    def _build_ilu(self, a):
+        ilu = spla.spilu(a.tocsc(), drop_tol=self._ilu_drop_tol, fill_factor=self._ilu_fill_factor)
+        return spla.LinearOperator(a.shape, ilu.solve)
+
+    def _build_cpr(self, a):
+        nb = self._block_size
+        n = a.shape[0]
+        ncells = n // nb
+        cells = np.arange(ncells)
+        a_csr = a.tocsr()
+        a_pp = np.asarray(a_csr[nb*cells, nb*cells]).ravel()
+        a_ps = np.asarray(a_csr[nb*cells, nb*cells+1]).ravel()
+        a_sp = np.asarray(a_csr[nb*cells+1, nb*cells]).ravel()
+        a_ss = np.asarray(a_csr[nb*cells+1, nb*cells+1]).ravel()
+        det = a_pp * a_ss - a_sp * a_ps
+        det = np.where(det == 0., 1., det)
+        w_p = a_ss / det
+        w_s = -a_ps / det
+        r = sp.csr_matrix((np.concatenate([w_p, w_s]), (np.concatenate([cells, cells]), np.concatenate([nb*cells, nb*cells+1]))), shape=(ncells, n))
+        p = sp.csr_matrix((np.ones(ncells), (nb*cells, cells)), shape=(n, ncells))
+        pressure_lu = spla.splu((r @ a_csr @ p).tocsc())
+        ilu = spla.spilu(a.tocsc(), drop_tol=self._ilu_drop_tol, fill_factor=self._ilu_fill_factor)
+
+        def apply(v):
+            x = p @ pressure_lu.solve(r @ v)
+            return x + ilu.solve(v - a_csr @ x)
+
+        return spla.LinearOperator(a.shape, apply)
+
+    def _build_preconditioner(self, a):
+        self._n_factorizations += 1
+        if self._preconditioner == 'cpr' and self._block_size > 1:
+            self._precond = self._build_cpr(a)
+        else:
+            self._precond = self._build_ilu(a)
+        self._precond_n = a.shape[0]
+
+    def _krylov(self, a, b, max_iter):
+        n_iter = [0]
+        def apply(v):
+            n_iter[0] += 1
+            return self._precond.matvec(v)
+        m = spla.LinearOperator(a.shape, apply)
+        if self._method == 'gmres':
+            restart = min(self._restart, max_iter)
+            x, info = spla.gmres(a, b, rtol=self._tol, atol=0., restart=restart, maxiter=max(max_iter // restart, 1), M=m)
+        else:
+            x, info = spla.bicgstab(a, b, rtol=self._tol, atol=0., maxiter=max_iter, M=m)
+        self._n_linear_iter += n_iter[0]
+        return x, info == 0
+
+    def _solve_krylov(self, a, b):
+        if b.ndim > 1:
+            return np.column_stack([self._solve_krylov(a, b[:, i]) for i in range(b.shape[1])])
+        if self._reuse and self._precond is not None and self._precond_n == a.shape[0]:
+            x, converged = self._krylov(a, b, self._max_reuse_iter)
+            if converged:
+                self._n_reused += 1
+                return x
+        self._build_preconditioner(a)
+        x, converged = self._krylov(a, b, self._max_krylov_iter)
+        if not converged:
+            self._n_failed += 1
+        return x
+
+    def _build_permutation(self, a):
+        nb = self._block_size
+        ncells = a.shape[0] // nb
+        if self._ordering == 'grid' and self._grid_shape is not None:
+            ni, nj, nk = self._grid_shape
+            cells = np.arange(ncells).reshape((nk, nj, ni))
+            sizes = [nk, nj, ni]
+            axes = sorted(range(3), key=lambda a: (-sizes[a], a))
+            order = np.transpose(cells, axes).ravel()
+        else:
+            coo = a.tocoo()
+            graph = sp.csr_matrix((np.ones(coo.nnz), (coo.row // nb, coo.col // nb)), shape=(ncells, ncells))
+            order = csgraph.reverse_cuthill_mckee(graph, symmetric_mode=False)
+        self._perm = (nb * np.repeat(order, nb) + np.tile(np.arange(nb), ncells)).astype(int)
+
+    def _solve_banded(self, a, b):
+        coo = a.tocoo()
+        bw = int(np.max(np.abs(coo.row - coo.col)))
+        self._bandwidth = bw
+        ab = np.zeros((2 * bw + 1, a.shape[0]))
+        np.add.at(ab, (bw + coo.row - coo.col, coo.col), coo.data)
+        return sla.solve_banded((bw, bw), ab, b)
+
+    def solve(self, a, b):
+        if self._ordering == 'natural' or not self.is_sparse():
+            return self._solve(a, b)
+        if self._perm is None or self._perm.size != a.shape[0]:
+            self._build_permutation(a)
+        perm = self._perm
+        x = self._solve(a[perm, :][:, perm].tocsc(), b[perm])
+        x_natural = np.empty_like(x)
+        x_natural[perm] = x
+        return x_natural
+
+    def _solve(self, a, b):
+        if self._method == 'banded':
+            return self._solve_banded(a, b)
+        if self.is_krylov():
+            return self._solve_krylov(a, b)
+        if not self._reuse:
+            if self.is_sparse():
+                return spla.splu(a).solve(b)
+            return np.linalg.solve(a, b)
+        if self._lu is not None and self._lu_n == a.shape[0]:
+            x = self._refine(a, b)
+            if x is not None:
+                self._n_reused += 1
+                return x
+        self._factorize(a)
+        return self._lu_solve(b)
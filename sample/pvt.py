@@ -1,6 +1,201 @@
 import math
 import common
 import numpy as np
+from collections import OrderedDict
+from scipy.interpolate import PchipInterpolator
+
+class PVTCache:
+
+    def __init__(self, max_size=10000, dp=None, dt=None):
+        self._data = OrderedDict()
+        self._max_size = max_size
+        self._dp = dp
+        self._dt = dt
+        self._hits = 0
+        self._misses = 0
+
+    def set_max_size(self, value):
+        self._max_size = value
+    def set_dp(self, value):
+        self._dp = value
+    def set_dt(self, value):
+        self._dt = value
+
+    def get_max_size(self):
+        return self._max_size
+    def get_dp(self):
+        return self._dp
+    def get_dt(self):
+        return self._dt
+    def get_size(self):
+        return len(self._data)
+    def get_hits(self):
+        return self._hits
+    def get_misses(self):
+        return self._misses
+
+    def clear(self):
+        self._data.clear()
+        self._hits = 0
+        self._misses = 0
+
+    def quantize_p(self, p):
+        if self._dp is None:
+            return p
+        return round(p / self._dp) * self._dp
+    def quantize_t(self, t):
+        if self._dt is None:
+            return t
+        return round(t / self._dt) * self._dt
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is None:
+            self._misses += 1
+            return None
+        self._data.move_to_end(key)
+        self._hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+class PVTTable:
+
+    def __init__(self):
+        self._variables = ['rs', 'p_bubble', 'co_bubble', 'bo_bubble', 'bo', 'uo_do', 'uo', 'z', 'bg']
+        self._methods = ['linear', 'pchip']
+        self._method = 'linear'
+        self._p = None
+        self._t = None
+        self._fluid = None
+        self._values = {}
+        self._slopes = {}
+        self._values_list = {}
+        self._slopes_list = {}
+
+    def set_method(self, method):
+        if method.lower() not in self._methods:
+            raise NameError(f'Unknown interpolation method ({method}). Valid methods: {self._methods}.')
+        self._method = method.lower()
+
+    def get_method(self):
+        return self._method
+    def get_p(self):
+        return self._p
+    def get_t(self):
+        return self._t
+    def get_fluid(self):
+        return self._fluid
+    def get_variables(self):
+        return self._variables
+    def get_values(self, name):
+        return self._values[name]
+
+    def build(self, pvt, p_min, p_max, n_p, t_min, t_max, n_t):
+        self._p = np.linspace(p_min, p_max, n_p)
+        self._t = np.linspace(t_min, t_max, n_t)
+        p, t = np.meshgrid(self._p, self._t)
+        out = pvt.calculate_Standing_array(p, t)
+        self._values = {name: out[name] for name in self._variables}
+        self._fluid = pvt.get_fluid_key()
+        self._prepare()
+
+    def _prepare(self):
+        self._p0 = float(self._p[0])
+        self._t0 = float(self._t[0])
+        self._dp = float(self._p[1] - self._p[0])
+        self._dt = float(self._t[1] - self._t[0]) if self._t.size > 1 else 1.
+        self._slopes = {}
+        for name, values in self._values.items():
+            self._slopes[name] = PchipInterpolator(self._p, values, axis=1).derivative()(self._p)
+            self._values_list[name] = values.tolist()
+            self._slopes_list[name] = self._slopes[name].tolist()
+
+    def save(self, file_name):
+        np.savez(file_name, p=self._p, t=self._t, fluid=np.array(self._fluid), **self._values)
+
+    def load(self, file_name):
+        with np.load(file_name) as data:
+            self._p = data['p']
+            self._t = data['t']
+            self._fluid = tuple(float(v) for v in data['fluid'])
+            self._values = {name: data[name] for name in self._variables}
+        self._prepare()
+
+    def matches(self, pvt):
+        return self._fluid == pvt.get_fluid_key()
+
+    def contains(self, p, t):
+        return (self._p[0] <= p <= self._p[-1]) and (self._t[0] <= t <= self._t[-1])
+
+    def _locate(self, x, x0, dx, n):
+        s = (x - x0) / dx
+        i = min(max(int(s), 0), n - 2) if n > 1 else 0
+        return i, s - i
+
+    def get(self, name, p, t):
+        if isinstance(p, (int, float)) and isinstance(t, (int, float)):
+            return self.get_scalars([name], p, t)[0]
+        return self.get_array(name, p, t)
+
+    def get_scalars(self, names, p, t):
+        ip, wp = self._locate(p, self._p0, self._dp, self._p.size)
+        it, wt = self._locate(t, self._t0, self._dt, self._t.size)
+        it1 = min(it + 1, self._t.size - 1)
+        linear = self._method == 'linear'
+        if not linear:
+            h00 = (1. + 2. * wp) * (1. - wp) * (1. - wp)
+            h10 = wp * (1. - wp) * (1. - wp) * self._dp
+            h01 = wp * wp * (3. - 2. * wp)
+            h11 = wp * wp * (wp - 1.) * self._dp
+        out = []
+        for name in names:
+            v0 = self._values_list[name][it]
+            v1 = self._values_list[name][it1]
+            if linear:
+                y0 = v0[ip] + wp * (v0[ip+1] - v0[ip])
+                y1 = v1[ip] + wp * (v1[ip+1] - v1[ip])
+            else:
+                m0 = self._slopes_list[name][it]
+                m1 = self._slopes_list[name][it1]
+                y0 = h00 * v0[ip] + h10 * m0[ip] + h01 * v0[ip+1] + h11 * m0[ip+1]
+                y1 = h00 * v1[ip] + h10 * m1[ip] + h01 * v1[ip+1] + h11 * m1[ip+1]
+            out.append(y0 + wt * (y1 - y0))
+        return out
+
+    def get_array(self, name, p, t):
+        p, t = np.broadcast_arrays(np.asarray(p, dtype=float), np.asarray(t, dtype=float))
+        sp = (p - self._p0) / self._dp
+        ip = np.clip(np.floor(sp).astype(int), 0, self._p.size - 2)
+        wp = sp - ip
+        st = (t - self._t0) / self._dt
+        it = np.clip(np.floor(st).astype(int), 0, max(self._t.size - 2, 0))
+        wt = st - it
+        it1 = np.minimum(it + 1, self._t.size - 1)
+        values = self._values[name]
+        if self._method == 'linear':
+            v0 = values[it, ip] + wp * (values[it, ip+1] - values[it, ip])
+            v1 = values[it1, ip] + wp * (values[it1, ip+1] - values[it1, ip])
+        else:
+            m = self._slopes[name]
+            h00 = (1. + 2. * wp) * (1. - wp) * (1. - wp)
+            h10 = wp * (1. - wp) * (1. - wp)
+            h01 = wp * wp * (3. - 2. * wp)
+            h11 = wp * wp * (wp - 1.)
+            v0 = h00 * values[it, ip] + h10 * self._dp * m[it, ip] + h01 * values[it, ip+1] + h11 * self._dp * m[it, ip+1]
+            v1 = h00 * values[it1, ip] + h10 * self._dp * m[it1, ip] + h01 * values[it1, ip+1] + h11 * self._dp * m[it1, ip+1]
+        return v0 + wt * (v1 - v0)
+
+    def get_max_error(self, pvt, name):
+        p = (self._p[:-1] + self._p[1:]) / 2.
+        t = (self._t[:-1] + self._t[1:]) / 2. if self._t.size > 1 else self._t
+        p, t = np.meshgrid(p, t)
+        exact = pvt.calculate_Standing_array(p, t)[name]
+        return np.max(np.abs(self.get_array(name, p, t) - exact) / np.abs(exact))
 
 class PVT:
 
@@ -58,6 +253,8 @@ class PVT:
         self._d = None
 
         self._check_values = True
+        self._cache = None
+        self._table = None
 
         self.variables = common.VariablesList({
             'wfr':['Water fraction', '-'],
@@ -145,6 +342,8 @@ class PVT:
         pvt._d = self._d
 
         pvt._check_values = self._check_values
+        pvt._cache = self._cache
+        pvt._table = self._table
         return pvt
 
     def _check_value(self,value, min_value, max_value):
@@ -156,6 +355,36 @@ class PVT:
     def set_check_values(self, check):
         self._check_values = check
 
+    def set_cache(self, max_size=10000, dp=None, dt=None):
+        self._cache = PVTCache(max_size, dp, dt)
+    def reset_cache(self):
+        self._cache = None
+    def get_cache(self):
+        return self._cache
+
+    def set_table(self, table):
+        self._table = table
+    def reset_table(self):
+        self._table = None
+    def get_table(self):
+        return self._table
+
+    def get_fluid_key(self):
+        return (self._api, self._dg, self._gor, self._y_co2, self._y_h2s, self._y_n2, self._p_std, self._t_std)
+
+    def _use_table(self):
+        if self._table is None or self._p is None or self._t is None:
+            return False
+        return self._table.contains(self._p, self._t) and self._table.matches(self)
+
+    def _set_from_table(self, variables):
+        if not self._use_table():
+            return False
+        values = self._table.get_scalars(variables, self._p, self._t)
+        for variable, value in zip(variables, values):
+            setattr(self, '_' + variable, value)
+        return True
+
     def set_wfr(self, wfr):
         self._check_value(wfr,0.,1.)
         self._wfr = wfr
@@ -636,6 +865,8 @@ class PVT:
         self._bo_bubble = 0.9759 +  12E-5 * math.pow(x + y, 1.2)
 
     def calculate_bo_Standing(self, auto=False):
+        if self._set_from_table(['rs', 'p_bubble', 'co_bubble', 'bo_bubble', 'bo']):
+            return
         self._check(['p'])
         if auto:
             if self._p_bubble is None:
@@ -724,6 +955,8 @@ class PVT:
         self._t_pr = (self._t  + 273.15)/ (self._t_pc + 273.15)
 
     def calculate_z_Standing(self, auto=False):
+        if self._set_from_table(['z']):
+            return
         if auto:
             if self._p_pr is None:
                 self.calculate_p_pr(True)
@@ -742,6 +975,8 @@ class PVT:
         self._z = a + (1 - a) / math.exp(b) + c * math.pow(p, d)
 
     def calculate_bg(self, auto=False):
+        if self._set_from_table(['z', 'bg']):
+            return
         self._check(['p','t'])
         if auto:
             if self._z is None:
@@ -758,6 +993,8 @@ class PVT:
         self._uo_do = x * y
 
     def calculate_uo_Standing(self, auto=False):
+        if self._set_from_table(['rs', 'uo_do', 'uo']):
+            return
         if auto:
             if self._rs is None:
                 self.calculate_rs_Standing()
@@ -770,7 +1007,58 @@ class PVT:
         b = 0.68 / math.pow(10, 8.62E-5 * rs) + 0.25 / math.pow(10, 1.1E-3 * rs) + 0.062 / math.pow(10, 3.74E-3 * rs)
         self._uo = A * math.pow(self._uo_do, b)
 
+    def _get_cache_key(self, name, p, t):
+        return (name, p, t, self._api, self._dg, self._gor)
+
+    def _update_cached(self, name, p, t, calculate_function, variables):
+        if self._table is not None:
+            self.set_t(t)
+            self.set_p(p)
+            if self._set_from_table([variable[1:] for variable in variables]):
+                return
+        if self._cache is None:
+            self.set_t(t)
+            self.set_p(p)
+            calculate_function()
+            return
+        p_key = self._cache.quantize_p(p)
+        t_key = self._cache.quantize_t(t)
+        key = self._get_cache_key(name, p_key, t_key)
+        values = self._cache.get(key)
+        if values is None:
+            self.set_t(t_key)
+            self.set_p(p_key)
+            calculate_function()
+            values = tuple(getattr(self, variable) for variable in variables)
+            self._cache.put(key, values)
+        for variable, value in zip(variables, values):
+            setattr(self, variable, value)
+        self.set_t(t)
+        self.set_p(p)
+
+    def _calculate_bo_chain_Standing(self):
+        self.calculate_rs_Standing()
+        self.calculate_p_bubble_Standing()
+        self.calculate_co_bubble_Standing()
+        self.calculate_bo_bubble_Standing()
+        self.calculate_bo_Standing()
+
+    def _calculate_uo_chain_Standing(self):
+        self.calculate_rs_Standing()
+        self.calculate_uo_do_Standing()
+        self.calculate_uo_Standing()
+
+    def update_bo_Standing(self, p, t):
+        self._update_cached('bo', p, t, self._calculate_bo_chain_Standing,
+                            ['_rs', '_p_bubble', '_co_bubble', '_bo_bubble', '_bo'])
+
+    def update_uo_Standing(self, p, t):
+        self._update_cached('uo', p, t, self._calculate_uo_chain_Standing,
+                            ['_rs', '_uo_do', '_uo'])
+
     def calculate_all_Standing(self):
+        if self._set_from_table(['rs', 'p_bubble', 'co_bubble', 'bo_bubble', 'bo', 'uo_do', 'uo']):
+            return
         self.calculate_rs_Standing()
         self.calculate_p_bubble_Standing()
         self.calculate_co_bubble_Standing()
@@ -778,3 +1066,84 @@ class PVT:
         self.calculate_bo_Standing()
         self.calculate_uo_do_Standing()
         self.calculate_uo_Standing()
+
+    def calculate_Standing_array(self, p, t):
+        self._check(['api','dg','gor'])
+        p, t = np.broadcast_arrays(np.asarray(p, dtype=float), np.asarray(t, dtype=float))
+        out = {'p':p, 't':t}
+        out['rs'] = rs_Standing(p, t, self._api, self._dg, self._gor)
+        out['p_bubble'] = p_bubble_Standing(t, self._api, self._dg, self._gor)
+        out['co_bubble'] = co_bubble_Standing(t, self._api, self._dg, self._gor, out['p_bubble'])
+        out['bo_bubble'] = bo_bubble_Standing(t, self._do, self._dg, self._gor)
+        out['bo'] = bo_Standing(p, t, self._do, self._dg, out['rs'], out['p_bubble'], out['bo_bubble'], out['co_bubble'])
+        out['uo_do'] = uo_do_Standing(t, self._api)
+        out['uo'] = uo_Standing(out['rs'], out['uo_do'])
+        out['rhoo'] = (self.get_rhoo_std() + out['rs'] * self.get_rhog_std()) / out['bo']
+        p_pr = p / p_pc_Standing(self._dg, self._y_co2, self._y_h2s, self._y_n2)
+        t_pr = (t + 273.15) / (t_pc_Standing(self._dg, self._y_co2, self._y_h2s, self._y_n2) + 273.15)
+        out['z'] = z_Standing(p_pr, t_pr)
+        out['bg'] = bg(p, t, out['z'], self._p_std, self._t_std)
+        out['rhog'] = self.get_rhog_std() / out['bg']
+        return out
+
+def rs_Standing(p, t, api, dg, gor):
+    x = 0.0125 * api - 0.00091 * (1.8 * t + 32)
+    y = p * np.power(10., x)
+    z = 0.1373 * dg * np.power(y, 1.205)
+    return np.minimum(z, gor)
+
+def p_bubble_Standing(t, api, dg, gor):
+    x = 0.0125 * api - 0.00091 * (1.8 * t + 32)
+    y = gor / dg / 0.1373
+    return np.power(y, 1/1.205) * np.power(10., -x)
+
+def co_bubble_Standing(t, api, dg, gor, p_bubble):
+    x = -1433. + 5 * 5.615 * gor
+    y = 17.2*(1.8 * t + 32.)
+    z = -1180. * dg + 12.61 * api
+    w = 1E5 * p_bubble
+    return (x + y + z) / w
+
+def bo_bubble_Standing(t, do, dg, gor):
+    x = 5.615 * gor * np.power(dg / do, 0.5)
+    y = 1.25 * (1.8 * t + 32)
+    return 0.9759 +  12E-5 * np.power(x + y, 1.2)
+
+def bo_Standing(p, t, do, dg, rs, p_bubble, bo_bubble, co_bubble):
+    bo_above = bo_bubble * np.exp(co_bubble * (p_bubble - p))
+    bo_below = bo_bubble_Standing(t, do, dg, rs)
+    return np.where(p > p_bubble, bo_above, bo_below)
+
+def p_pc_Standing(dg, y_co2, y_h2s, y_n2):
+    x = 706. - 51.7 * dg - 11.1 * dg * dg
+    y = 440. * y_co2 + 600. * y_h2s - 170. * y_n2
+    return (x + y) / 14.503773773375086
+
+def t_pc_Standing(dg, y_co2, y_h2s, y_n2):
+    x = 187. + 330. * dg - 71.5 * dg * dg
+    y = - 80. * y_co2 + 130. * y_h2s - 250. * y_n2
+    return (x + y - 491.67) * 5./9.
+
+def z_Standing(p_pr, t_pr):
+    p = p_pr
+    t = t_pr
+    a = 1.39 * np.power(t - 0.92, 0.5) - 0.36 * t - 0.101
+    b = (0.62 - 0.23 * t) * p + ( 0.066/(t - 0.86) -0.037) * p * p + 0.32 / np.power(10., 9*(t - 1)) * np.power(p,6)
+    c = 0.132 - 0.32 * np.log10(t)
+    d = np.power(10., 0.3106 - 0.49 * t + 0.1824 *t * t)
+    return a + (1 - a) / np.exp(b) + c * np.power(p, d)
+
+def bg(p, t, z, p_std=1.01325, t_std=20.):
+    return z * p_std / p * (t + 273.15) / (t_std + 273.15)
+
+def uo_do_Standing(t, api):
+    a = np.power(10., 0.43 + 8.33 / api)
+    x = 0.32 + 1.8E7 / np.power(api, 4.53)
+    y = np.power(360 / (1.8 * t + 232), a)
+    return x * y
+
+def uo_Standing(rs, uo_do):
+    rs = 5.615 * rs
+    A = np.power(10., rs * (2.2E-7 * rs - 7.4E-4))
+    b = 0.68 / np.power(10., 8.62E-5 * rs) + 0.25 / np.power(10., 1.1E-3 * rs) + 0.062 / np.power(10., 3.74E-3 * rs)
+    return A * np.power(uo_do, b)
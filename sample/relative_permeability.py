@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 class Saturations:
 
@@ -128,4 +129,172 @@ class Corey:
             return 0.
         if sw >= (1 - self.sat.get_sorw()):
             return 0.
-        return -1. * self.get_kro_max() * self.get_now() * math.pow(self.sat.get_sodw(sw), self.get_now() - 1.) / (1 - self.sat.get_sorw() - self.sat.get_swi())
\ No newline at end of file
+        return -1. * self.get_kro_max() * self.get_now() * math.pow(self.sat.get_sodw(sw), self.get_now() - 1.) / (1 - self.sat.get_sorw() - self.sat.get_swi())
+
+    def get_krw_2f_array(self, sw):
+        return krw_Corey(sw, self.sat.get_swc(), self.sat.get_sorw(), self.get_krw_max(), self.get_nw())
+    def get_krow_2f_array(self, sw):
+        return krow_Corey(sw, self.sat.get_swi(), self.sat.get_sorw(), self.get_kro_max(), self.get_now())
+
+    def get_dkrw_2f_array(self, sw):
+        return dkrw_Corey(sw, self.sat.get_swc(), self.sat.get_sorw(), self.get_krw_max(), self.get_nw())
+    def get_dkrow_2f_array(self, sw):
+        return dkrow_Corey(sw, self.sat.get_swi(), self.sat.get_sorw(), self.get_kro_max(), self.get_now())
+
+class KrTable:
+
+    def __init__(self):
+        self.sat = Saturations()
+        self._n_points = 1001
+        self._sw = None
+        self._krw = None
+        self._krow = None
+
+    def set_n_points(self, n):
+        self._n_points = n
+        if self._sw is not None:
+            self._prepare()
+    def set_table(self, sw, krw, krow):
+        sw = np.asarray(sw, dtype=float)
+        krw = np.asarray(krw, dtype=float)
+        krow = np.asarray(krow, dtype=float)
+        if sw.ndim != 1 or sw.size < 2 or sw.shape != krw.shape or sw.shape != krow.shape:
+            raise ValueError('Sw, Krw and Krow must be 1D arrays of the same size (at least 2 points).')
+        if np.any(np.diff(sw) <= 0.):
+            raise ValueError('Sw must be strictly increasing.')
+        self._sw = sw
+        self._krw = krw
+        self._krow = krow
+        self._set_end_points()
+        self._prepare()
+
+    def get_n_points(self):
+        return self._n_points
+    def get_sw(self):
+        return self._sw
+    def get_krw(self):
+        return self._krw
+    def get_krow(self):
+        return self._krow
+    def get_krw_max(self):
+        return self._krw[-1]
+    def get_kro_max(self):
+        return self._krow[0]
+
+    def load(self, file_name):
+        data = np.loadtxt(file_name, ndmin=2)
+        self.set_table(data[:,0], data[:,1], data[:,2])
+
+    def _set_end_points(self):
+        sw_krw_zero = self._sw[self._krw <= 0.]
+        swc = sw_krw_zero[-1] if sw_krw_zero.size > 0 else self._sw[0]
+        sw_kro_zero = self._sw[self._krow <= 0.]
+        sorw = 1. - sw_kro_zero[0] if sw_kro_zero.size > 0 else 1. - self._sw[-1]
+        self.sat.set_swi(float(swc))
+        self.sat.set_swc(float(swc))
+        self.sat.set_sorw(float(sorw))
+
+    def _prepare(self):
+        # resample on a uniform Sw grid, so that the interval is found with one division
+        grid = np.linspace(self._sw[0], self._sw[-1], self._n_points)
+        self._sw0 = float(grid[0])
+        self._sw_end = float(grid[-1])
+        self._dsw = float(grid[1] - grid[0])
+        self._grid = grid
+        self._krw_values = np.interp(grid, self._sw, self._krw)
+        self._krow_values = np.interp(grid, self._sw, self._krow)
+        self._krw_slopes = np.diff(self._krw_values) / self._dsw
+        self._krow_slopes = np.diff(self._krow_values) / self._dsw
+
+    def _get_interval(self, sw):
+        sw = np.clip(np.asarray(sw, dtype=float), self._sw0, self._sw_end)
+        index = np.minimum(((sw - self._sw0) / self._dsw).astype(np.intp), self._n_points - 2)
+        return index, sw - self._grid[index]
+
+    def _get_slope(self, sw, slopes):
+        sw = np.asarray(sw, dtype=float)
+        index, _ = self._get_interval(sw)
+        # flat extrapolation outside the table
+        return np.where((sw < self._sw0) | (sw > self._sw_end), 0., slopes[index])
+
+    def get_krw_2f_array(self, sw):
+        index, dsw = self._get_interval(sw)
+        return self._krw_values[index] + self._krw_slopes[index] * dsw
+    def get_krow_2f_array(self, sw):
+        index, dsw = self._get_interval(sw)
+        return self._krow_values[index] + self._krow_slopes[index] * dsw
+
+    def get_dkrw_2f_array(self, sw):
+        return self._get_slope(sw, self._krw_slopes)
+    def get_dkrow_2f_array(self, sw):
+        return self._get_slope(sw, self._krow_slopes)
+
+    def get_krw_2f(self, sw):
+        return float(self.get_krw_2f_array(sw))
+    def get_krow_2f(self, sw):
+        return float(self.get_krow_2f_array(sw))
+
+    def get_dkrw_2f(self, sw):
+        return float(self.get_dkrw_2f_array(sw))
+    def get_dkrow_2f(self, sw):
+        return float(self.get_dkrow_2f_array(sw))
+
+def _expand(sw, *args):
+    # scalar parameters are kept as they are; arrays (one value per model) are broadcast to sw
+    sw = np.asarray(sw, dtype=float)
+    return [sw] + [a if np.ndim(a) == 0 else np.broadcast_to(a, sw.shape) for a in args]
+
+def _at(value, mask):
+    return value if np.ndim(value) == 0 else value[mask]
+
+# np.float_power uses the C pow like math.pow (np.power may not), so these match the scalar Corey methods bit for bit
+def krw_Corey(sw, swc, sorw, krw_max, nw):
+    sw, swc, sorw, krw_max, nw = _expand(sw, swc, sorw, krw_max, nw)
+    kr = np.zeros(sw.shape)
+    high = (sw > (1 - sorw)) & (sw > swc)
+    mid = (sw > swc) & ~high
+    swc_mid = _at(swc, mid)
+    swd = (sw[mid] - swc_mid) / (1 - _at(sorw, mid) - swc_mid)
+    kr[mid] = _at(krw_max, mid) * np.float_power(swd, _at(nw, mid))
+    if np.any(high):
+        krw_high = _at(krw_max, high)
+        sorw_high = _at(sorw, high)
+        kr[high] = krw_high + (1. - krw_high) * (sw[high] - (1. - sorw_high)) / sorw_high
+    return kr
+
+def krow_Corey(sw, swi, sorw, kro_max, now):
+    sw, swi, sorw, kro_max, now = _expand(sw, swi, sorw, kro_max, now)
+    kr = np.zeros(sw.shape)
+    kr[...] = kro_max
+    high = (sw >= (1 - sorw)) & (sw > swi)
+    mid = (sw > swi) & ~high
+    swi_mid = _at(swi, mid)
+    sodw = 1 - (sw[mid] - swi_mid) / (1 - _at(sorw, mid) - swi_mid)
+    kr[mid] = _at(kro_max, mid) * np.float_power(sodw, _at(now, mid))
+    kr[high] = 0.
+    return kr
+
+def dkrw_Corey(sw, swc, sorw, krw_max, nw):
+    sw, swc, sorw, krw_max, nw = _expand(sw, swc, sorw, krw_max, nw)
+    dkr = np.zeros(sw.shape)
+    high = (sw > (1 - sorw)) & (sw > swc)
+    mid = (sw > swc) & ~high
+    swc_mid = _at(swc, mid)
+    sorw_mid = _at(sorw, mid)
+    nw_mid = _at(nw, mid)
+    swd = (sw[mid] - swc_mid) / (1 - sorw_mid - swc_mid)
+    dkr[mid] = _at(krw_max, mid) * nw_mid * np.float_power(swd, nw_mid - 1.) / (1 - sorw_mid - swc_mid)
+    if np.any(high):
+        dkr[high] = (1. - _at(krw_max, high)) / _at(sorw, high)
+    return dkr
+
+def dkrow_Corey(sw, swi, sorw, kro_max, now):
+    sw, swi, sorw, kro_max, now = _expand(sw, swi, sorw, kro_max, now)
+    dkr = np.zeros(sw.shape)
+    mid = (sw > swi) & (sw < (1 - sorw))
+    swi_mid = _at(swi, mid)
+    sorw_mid = _at(sorw, mid)
+    now_mid = _at(now, mid)
+    sodw = 1 - (sw[mid] - swi_mid) / (1 - sorw_mid - swi_mid)
+    dkr[mid] = -1. * _at(kro_max, mid) * now_mid * np.float_power(sodw, now_mid - 1.) / (1 - sorw_mid - swi_mid)
+    return dkr
@@ -1,11 +1,121 @@
 # import math
+import copy
 import numpy as np
 import relative_permeability
+import linear_solver
+import common
+import time_step
 # import pvt
 from tqdm import tqdm
 
 unit_conv = 0.00852702 # units: bar, mD, cP, m, m3/d
 
+# Discretization terms shared by Simple2D_OW and Ensemble. Cell and perforation arrays
+# may have a leading model axis; per-model properties then have shape (n_models, 1).
+
+def _get_upwind(pr, c1, c2, gamma_o=None, gamma_w=None, dz=None):
+    if gamma_o is None:
+        up = np.where(pr[..., c1] > pr[..., c2], c1, c2)
+        return up, up
+    up_o = np.where(pr[..., c1] > pr[..., c2] - gamma_o * dz, c1, c2)
+    up_w = np.where(pr[..., c1] > pr[..., c2] - gamma_w * dz, c1, c2)
+    return up_o, up_w
+
+def _get_phase_tr(tr, kr, up, b_u):
+    return tr * np.take_along_axis(kr, up, axis=-1) / b_u
+
+def _get_perf_mobility(wi, kro, krw, bo_uo, bw_uw, is_prod):
+    lo = wi * kro / bo_uo
+    lw = wi * krw / bw_uw
+    return np.where(is_prod, lo, 0.), lw
+
+def _get_perf_rate_split(q, lo, lw, is_prod):
+    # Rate producers split the liquid rate by mobility. Rate injectors inject water only.
+    lt = lo + lw
+    qo = q * lo / np.where(lt > 0., lt, np.inf)
+    qw = np.where(is_prod, q - qo, -q)
+    return qo, qw
+
+def _get_k_values(tro, trw, vp_dt, bo, bw, lo_bhp, lw_bhp):
+    # values for the rows and columns of Simple2D_OW._get_k_index
+    return np.concatenate([-tro, -trw, tro, trw, vp_dt / bo, -1. * vp_dt / bw, -lo_bhp, -lw_bhp], axis=-1)
+
+def _get_f(vp_dt, sw_previous, bo, bw, f_rows, qo, qw, lo_bhp, lw_bhp, value_bhp):
+    f = np.zeros(sw_previous.shape[:-1] + (2 * sw_previous.shape[-1],))
+    f[..., 0::2] = vp_dt / bo * sw_previous
+    f[..., 1::2] = -1. * vp_dt / bw * sw_previous
+    np.add.at(f, (Ellipsis, f_rows), np.concatenate([qo, qw, -(lo_bhp * value_bhp), -(lw_bhp * value_bhp)], axis=-1))
+    return f
+
+def _get_g(tro, trw, c1, gamma_o, gamma_w, dz, nvars):
+    g = np.zeros(tro.shape[:-1] + (nvars,))
+    np.add.at(g, (Ellipsis, 2*c1), tro * gamma_o * dz)
+    np.add.at(g, (Ellipsis, 2*c1+1), trw * gamma_w * dz)
+    return g
+
+class Well:
+
+    def __init__(self, name):
+        self._name = name
+        self._i = None
+        self._j = None
+        self._k1 = None
+        self._k2 = None
+        self._types = ['producer', 'injector']
+        self._type = 'producer'
+        self._controls = ['bhp', 'rate']
+        self._control = 'bhp'
+        self._value = None
+        self._rw = None
+        self._skin = 0.
+
+    def set_location(self, i, j):
+        self._i = i
+        self._j = j
+    def set_layers(self, k1, k2):
+        self._k1 = k1
+        self._k2 = k2
+    def set_type(self, value):
+        if value.lower() not in self._types:
+            raise NameError(f'Unknown well type ({value}). Valid types: {self._types}.')
+        self._type = value.lower()
+    def set_control(self, value):
+        if value.lower() not in self._controls:
+            raise NameError(f'Unknown well control ({value}). Valid controls: {self._controls}.')
+        self._control = value.lower()
+    def set_value(self, value):
+        self._value = value
+    def set_rw(self, value):
+        self._rw = value
+    def set_skin(self, value):
+        self._skin = value
+
+    def get_name(self):
+        return self._name
+    def get_location(self):
+        return self._i, self._j
+    def get_i(self):
+        return self._i
+    def get_j(self):
+        return self._j
+    def get_layers(self):
+        return self._k1, self._k2
+    def get_type(self):
+        return self._type
+    def get_control(self):
+        return self._control
+    def get_value(self):
+        return self._value
+    def get_rw(self):
+        return self._rw
+    def get_skin(self):
+        return self._skin
+
+    def is_producer(self):
+        return self._type == 'producer'
+    def is_rate_controlled(self):
+        return self._control == 'rate'
+
 class Simple2D_OW:
 
     def __init__(self, debug=False):
@@ -19,7 +129,21 @@ class Simple2D_OW:
         self._phi = None
         self._k = None
         self._p_init = None
+        self._phi_layers = None
+        self._k_layers = None
+        self._dk_layers = None
+        self._properties = ['phi', 'k', 'di', 'dj', 'dk']
+        self._arrays = {}
+        self._kv_kh = 1.
+        self._rho_o = None
+        self._rho_w = None
+        self._top = 0.
+        self._gravity_on = False
+        self._gamma_o = 0.
+        self._gamma_w = 0.
         self.kr = relative_permeability.Corey()
+        self.linear_solver = linear_solver.LinearSolver()
+        self.step_controller = time_step.StepController()
         # self.pvt = pvt.PVT()
         self._bo = None
         self._bw = None
@@ -30,11 +154,27 @@ class Simple2D_OW:
         self._rw = None
         self._skin = 0.
         self._pwf = None
-        self._wi = None
 
         self._rw_inj = None
         self._skin_inj = 0.
-        self._wi_inj = None
+
+        self._wells = []
+        self._sim_wells = None
+        self._prod_index = None
+        self._inj_index = None
+        self._well_is_prod = None
+        self._well_is_rate = None
+        self._well_value = None
+        self._perf_cell = None
+        self._perf_well = None
+        self._perf_wi = None
+        self._perf_frac = None
+        self._perf_is_prod = None
+        self._perf_is_rate = None
+        self._perf_rate = None
+        self._perf_bhp = None
+        self._perf_f_rows = None
+        self._perf_head = None
 
         self._max_dsw = None
         self._max_dpr = None
@@ -44,18 +184,50 @@ class Simple2D_OW:
         self._converged_eq_system = True
         self._first_cell_dsw = 0.
 
+        self._nonlinear_solvers = ['picard', 'newton']
+        self._nonlinear_solver = 'picard'
+        self._formulations = ['implicit', 'impes']
+        self._formulation = 'implicit'
+        self._cfl = 1.
+        self._max_iter = 50
+        self._target_iter = 25
+        self._newton_tol = 1e-3
+        self._newton_max_dsw = 0.2
+        self._n_iter = 0
+        self._n_linear_iter = 0
+        self._linear_iter_list = []
+
         self._di_mat = None
         self._dj_mat = None
         self._phi_mat = None
+        self._dk_mat = None
         self._k_mat = None
         self._pr_mat = None
         self._sw_mat = None
+        self._depth = None
+
+        self._face_c1 = None
+        self._face_c2 = None
+        self._face_tr = None
+        self._face_dz = None
+        self._conn_c1 = None
+        self._conn_c2 = None
+        self._conn_tr = None
+        self._conn_dz = None
+        self._pore_volume = None
 
         self._ncells = None
         self._nvars = None
         self._t_list = []
-        self._x_list = []
+        self._x_history = None
+        self._x_last = None
+        self._well_history = None
         self._x_current = None
+        self._history_dtype = np.float64
+        self._response_key = None
+        self._proposed_dt = None
+        self._response_x0 = None
+        self._response_x1 = None
         self._a = None
         self._b = None
 
@@ -69,8 +241,12 @@ class Simple2D_OW:
         self._hi = value
     def set_hj(self, value):
         self._hj = value
+    def set_nk(self, value):
+        self._nk = value
     def set_hk(self, value):
         self._hk = value
+    def set_dk_layers(self, values):
+        self._dk_layers = values
 
     def set_phi(self, value):
         self._phi = value
@@ -78,6 +254,56 @@ class Simple2D_OW:
         self._k = value
     def set_p_init(self, value):
         self._p_init = value
+    def set_phi_layers(self, values):
+        self._phi_layers = values
+    def set_k_layers(self, values):
+        self._k_layers = values
+    def set_kv_kh(self, value):
+        self._kv_kh = value
+    def set_rho_o(self, value):
+        self._rho_o = value
+    def set_rho_w(self, value):
+        self._rho_w = value
+    def set_top(self, value):
+        self._top = value
+
+    def set_phi_array(self, values):
+        self._set_array('phi', values)
+    def set_k_array(self, values):
+        self._set_array('k', values)
+    def set_di_array(self, values):
+        self._set_array('di', values)
+    def set_dj_array(self, values):
+        self._set_array('dj', values)
+    def set_dk_array(self, values):
+        self._set_array('dk', values)
+
+    def _set_array(self, name, values):
+        if values is None:
+            self._arrays.pop(name, None)
+            return
+        if name.lower() not in self._properties:
+            raise NameError(f'Unknown property ({name}). Valid properties: {self._properties}.')
+        # kept as given: the grid size may still change, so the shape is checked in initialize()
+        self._arrays[name.lower()] = np.asanyarray(values)
+
+    def _get_array_mat(self, name, shape):
+        values = self._arrays[name]
+        if values.ndim == 1 and values.size == np.prod(shape):
+            values = values.reshape(shape, order='F')
+        elif values.shape == shape[:2]:
+            values = np.broadcast_to(values[:, :, np.newaxis], shape)
+        if values.shape != shape:
+            raise ValueError(f'Property {name} has shape {values.shape}, expected {shape}.')
+        return values
+
+    def load_property(self, name, file_name, dtype=np.float64):
+        # .npy files are memory-mapped as they are; raw binary files hold ni*nj*nk values, i fastest.
+        if str(file_name).endswith('.npy'):
+            values = np.load(file_name, mmap_mode='r')
+        else:
+            values = np.memmap(file_name, dtype=dtype, mode='r')
+        self._set_array(name, values)
 
     def set_bo(self, value):
         self._bo = value
@@ -94,9 +320,11 @@ class Simple2D_OW:
         self._skin = value
     def set_pwf(self, value):
         self._pwf = value
+        self._set_main_well_value(self._prod_index, 'bhp', value)
 
     def set_qwi(self, value):
         self._qwi = value
+        self._set_main_well_value(self._inj_index, 'rate', value)
     def set_rw_inj(self, value):
         self._rw_inj = value
     def set_skin_inj(self, value):
@@ -116,6 +344,27 @@ class Simple2D_OW:
     def set_first_cell_dsw(self, value):
         self._first_cell_dsw = value
 
+    def set_nonlinear_solver(self, value):
+        if value.lower() not in self._nonlinear_solvers:
+            raise NameError(f'Unknown non-linear solver ({value}). Valid solvers: {self._nonlinear_solvers}.')
+        self._nonlinear_solver = value.lower()
+    def set_formulation(self, value):
+        if value.lower() not in self._formulations:
+            raise NameError(f'Unknown formulation ({value}). Valid formulations: {self._formulations}.')
+        self._formulation = value.lower()
+    def set_cfl(self, value):
+        self._cfl = value
+    def set_max_iter(self, value):
+        self._max_iter = value
+    def set_target_iter(self, value):
+        self._target_iter = value
+    def set_newton_tol(self, value):
+        self._newton_tol = value
+    def set_newton_max_dsw(self, value):
+        self._newton_max_dsw = value
+    def set_history_dtype(self, value):
+        self._history_dtype = np.dtype(value)
+
     def get_ni(self):
         return self._ni
     def get_nj(self):
@@ -124,8 +373,12 @@ class Simple2D_OW:
         return self._hi
     def get_hj(self):
         return self._hj
+    def get_nk(self):
+        return self._nk
     def get_hk(self):
         return self._hk
+    def get_dk_layers(self):
+        return self._dk_layers
 
     def get_phi(self):
         return self._phi
@@ -133,6 +386,29 @@ class Simple2D_OW:
         return self._k
     def get_p_init(self):
         return self._p_init
+    def get_phi_layers(self):
+        return self._phi_layers
+    def get_k_layers(self):
+        return self._k_layers
+    def get_kv_kh(self):
+        return self._kv_kh
+    def get_rho_o(self):
+        return self._rho_o
+    def get_rho_w(self):
+        return self._rho_w
+    def get_top(self):
+        return self._top
+
+    def get_phi_array(self):
+        return self._arrays.get('phi')
+    def get_k_array(self):
+        return self._arrays.get('k')
+    def get_di_array(self):
+        return self._arrays.get('di')
+    def get_dj_array(self):
+        return self._arrays.get('dj')
+    def get_dk_array(self):
+        return self._arrays.get('dk')
 
     def get_bo(self):
         return self._bo
@@ -167,170 +443,688 @@ class Simple2D_OW:
     def get_t_end(self):
         return self._t_end
 
+    def get_nonlinear_solver(self):
+        return self._nonlinear_solver
+    def get_formulation(self):
+        return self._formulation
+    def get_cfl(self):
+        return self._cfl
+    def get_max_iter(self):
+        return self._max_iter
+    def get_target_iter(self):
+        return self._target_iter
+    def get_newton_tol(self):
+        return self._newton_tol
+    def get_newton_max_dsw(self):
+        return self._newton_max_dsw
+    def get_n_iter(self):
+        return self._n_iter
+    def get_n_linear_iter(self):
+        return self._n_linear_iter
+    def get_linear_iter(self):
+        return self._linear_iter_list
+    def get_history_dtype(self):
+        return self._history_dtype
+
+    def add_well(self, well):
+        if well.get_name() in [w.get_name() for w in self._wells]:
+            raise NameError(f'Well {well.get_name()} already exists.')
+        self._wells.append(well)
+        self._sim_wells = None
+        self._prod_index = None
+        self._inj_index = None
+    def reset_wells(self):
+        self._wells = []
+        self._sim_wells = None
+        self._prod_index = None
+        self._inj_index = None
+
+    def get_wells(self):
+        if self._sim_wells is not None:
+            return self._sim_wells
+        return self._wells
+    def get_well(self, name):
+        for well in self.get_wells():
+            if well.get_name() == name:
+                return well
+        raise NameError(f'Unknown well ({name}). Valid wells: {[w.get_name() for w in self.get_wells()]}.')
+    def get_well_index(self, name):
+        w = self.get_wells().index(self.get_well(name))
+        return float(np.sum(self._perf_wi[self._perf_well == w]))
+
+    def _set_main_well_value(self, index, control, value):
+        if index is None:
+            return
+        well = self._sim_wells[index]
+        if well.get_control() == control:
+            well.set_value(value)
+            self._well_value[index] = np.nan if value is None else value
+
     def reset_sim(self):
         self._t_list = []
-        self._x_list = []
+        self._x_history = None
+        self._x_last = None
+        self._response_key = None
+        self._proposed_dt = None
+
+    def _get_property_mat(self, name, layer_values, value):
+        shape = (self.get_ni(), self.get_nj(), self.get_nk())
+        if name in self._arrays:
+            return self._get_array_mat(name, shape)
+        if layer_values is None:
+            return np.full(shape, value)
+        return np.broadcast_to(np.asarray(layer_values, dtype=float), shape).copy()
 
     def initialize(self):
-        self._di_mat = np.full((self.get_ni(), self.get_nj()), self.get_hi() / self.get_ni())
-        self._dj_mat = np.full((self.get_ni(), self.get_nj()), self.get_hj() / self.get_nj())
-        self._phi_mat = np.full((self.get_ni(), self.get_nj()), self.get_phi())
-        self._k_mat = np.full((self.get_ni(), self.get_nj()), self.get_k())
-        self._pr_mat = np.full((self.get_ni(), self.get_nj()), self.get_p_init())
-        self._sw_mat = np.full((self.get_ni(), self.get_nj()), self.kr.sat.get_swi())
+        shape = (self.get_ni(), self.get_nj(), self.get_nk())
+        self._di_mat = self._get_property_mat('di', None, self.get_hi() / self.get_ni())
+        self._dj_mat = self._get_property_mat('dj', None, self.get_hj() / self.get_nj())
+        self._dk_mat = self._get_property_mat('dk', self._dk_layers, self.get_hk() / self.get_nk())
+        self._phi_mat = self._get_property_mat('phi', self._phi_layers, self.get_phi())
+        self._k_mat = self._get_property_mat('k', self._k_layers, self.get_k())
+        self._depth = self._get_cell_values(self._top + np.cumsum(self._dk_mat, axis=2) - self._dk_mat / 2.)
+
+        g = 9.80665e-5 # bar / m per kg / m3
+        self._gamma_o = 0. if self._rho_o is None else self._rho_o * g
+        self._gamma_w = 0. if self._rho_w is None else self._rho_w * g
+        self._gravity_on = self.get_nk() > 1 and (self._gamma_o != 0. or self._gamma_w != 0.)
+
+        self._pr_mat = np.full(shape, self.get_p_init())
+        if self._gravity_on:
+            depth = self._depth.reshape(shape, order='F')
+            self._pr_mat += self._gamma_o * (depth - depth[0, 0, 0])
+        self._sw_mat = np.full(shape, self.kr.sat.get_swi())
 
-        self._sw_mat[0,0] += self._first_cell_dsw
+        self._sw_mat[0,0,0] += self._first_cell_dsw
 
-        self._ncells = self.get_ni() * self.get_nj()
+        self._ncells = self.get_ni() * self.get_nj() * self.get_nk()
         self._nvars = 2 * self._ncells
 
+        self._build_faces()
+        self.linear_solver.set_grid_shape(self.get_ni(), self.get_nj(), self.get_nk())
+        if self._formulation == 'impes':
+            self.linear_solver.set_block_size(1)
+        else:
+            self.linear_solver.set_block_size(2)
+        self._pore_volume = self._get_cell_values(self._di_mat * self._dj_mat * self._dk_mat * self._phi_mat)
+
+    def _get_legacy_wells(self):
+        prod = Well('PROD')
+        prod.set_location(self.get_ni() - 1, self.get_nj() - 1)
+        prod.set_type('producer')
+        prod.set_control('bhp')
+        prod.set_value(self.get_pwf())
+        prod.set_rw(self.get_rw())
+        prod.set_skin(self.get_skin())
+
+        inj = Well('INJ')
+        inj.set_location(0, 0)
+        inj.set_type('injector')
+        inj.set_control('rate')
+        inj.set_value(self.get_qwi())
+        inj.set_rw(self.get_rw_inj())
+        inj.set_skin(self.get_skin_inj())
+        return [prod, inj]
+
+    def _build_wells(self):
+        if len(self._wells) == 0:
+            self._sim_wells = self._get_legacy_wells()
+        else:
+            # trials change the control values of the simulation wells, not the wells given by the user
+            self._sim_wells = [copy.copy(w) for w in self._wells]
+        wells = self._sim_wells
+        self._well_is_prod = np.array([w.is_producer() for w in wells], dtype=bool)
+        self._well_is_rate = np.array([w.is_rate_controlled() for w in wells], dtype=bool)
+        producers = np.flatnonzero(self._well_is_prod)
+        injectors = np.flatnonzero(~self._well_is_prod)
+        self._prod_index = int(producers[0]) if producers.size > 0 else None
+        self._inj_index = int(injectors[0]) if injectors.size > 0 else None
+        for index, control, value in [(self._prod_index, 'bhp', self._pwf), (self._inj_index, 'rate', self._qwi)]:
+            if index is None or wells[index].get_control() != control:
+                continue
+            if wells[index].get_value() is None:
+                wells[index].set_value(value)
+            elif control == 'bhp':
+                self._pwf = wells[index].get_value()
+            else:
+                self._qwi = wells[index].get_value()
+        self._well_value = np.array([np.nan if w.get_value() is None else w.get_value() for w in wells], dtype=float)
+
+        layers = []
+        for w in wells:
+            k1, k2 = w.get_layers()
+            layers.append(np.arange(0 if k1 is None else k1, self.get_nk() if k2 is None else k2 + 1))
+        self._perf_well = np.repeat(np.arange(len(wells)), [k.size for k in layers])
+        k = np.concatenate(layers).astype(int)
+        i = np.array([w.get_i() for w in wells], dtype=int)[self._perf_well]
+        j = np.array([w.get_j() for w in wells], dtype=int)[self._perf_well]
+        rw = np.array([w.get_rw() for w in wells], dtype=float)[self._perf_well]
+        skin = np.array([w.get_skin() for w in wells], dtype=float)[self._perf_well]
+        di = self._di_mat[i, j, k]
+        dj = self._dj_mat[i, j, k]
+        a = dj / di
+        ro = di * np.exp(-(a*np.pi - np.log(a))/(1. + a*a))
+        self._perf_cell = i + j * self.get_ni() + k * self.get_ni() * self.get_nj()
+        self._perf_wi = unit_conv * 2. * np.pi * self._k_mat[i, j, k] * self._dk_mat[i, j, k] / (np.log(ro/rw) + skin)
+
+        # Wellbore head from the top perforation: oil in producers, water in injectors.
+        depth = self._depth[self._perf_cell]
+        depth_ref = np.full(len(wells), np.inf)
+        np.minimum.at(depth_ref, self._perf_well, depth)
+        gamma = np.where(self._well_is_prod, self._gamma_o, self._gamma_w)[self._perf_well]
+        self._perf_head = gamma * (depth - depth_ref[self._perf_well])
+        well_wi = np.bincount(self._perf_well, weights=self._perf_wi, minlength=len(wells))
+        self._perf_frac = self._perf_wi / well_wi[self._perf_well]
+        self._perf_is_prod = self._well_is_prod[self._perf_well]
+        self._perf_is_rate = self._well_is_rate[self._perf_well]
+        self._perf_rate = np.flatnonzero(self._perf_is_rate)
+        self._perf_bhp = np.flatnonzero(~self._perf_is_rate)
+        rate_cell = self._perf_cell[self._perf_rate]
+        bhp_cell = self._perf_cell[self._perf_bhp]
+        self._perf_f_rows = np.concatenate([2*rate_cell, 2*rate_cell+1, 2*bhp_cell, 2*bhp_cell+1])
+
     def start_simulation(self):
-        a = self._dj_mat[-1,-1] / self._di_mat[-1,-1]
-        ro = self._di_mat[-1,-1] * np.exp(-(a*np.pi - np.log(a))/(1. + a*a))
-        self._wi = unit_conv * 2. * np.pi * self._k_mat[-1, -1] * self.get_hk() / (np.log(ro/self.get_rw()) + self.get_skin())
-        self._wi_inj = unit_conv * 2. * np.pi * self._k_mat[0, 0] * self.get_hk() / (np.log(ro/self.get_rw_inj()) + self.get_skin_inj())
+        self._build_wells()
 
         self._t_list = [0.]
         x = np.zeros(self._nvars)
-        x[::2] = self._pr_mat.flatten()
-        x[1::2] = self._sw_mat.flatten()
-        x = x.reshape((self._nvars, 1))
-        self._x_list.append(x.copy())
-
-    def get_cell_number(self, i, j):
-        return i+1 + j * self.get_ni()
-
-    def get_kro(self, x, i1, j1, i2, j2):
-        c1 = self.get_cell_number(i1,j1)
-        c2 = self.get_cell_number(i2,j2)
-        if c1 == c2:
-            sw1 = x[c1*2-1]
-            return self.kr.get_krow_2f(sw1)
-        p1 = x[c1*2-2]
-        p2 = x[c2*2-2]
-        if (p1 > p2):
-            sw = x[c1*2-1]
-        else:
-            sw = x[c2*2-1]
-        return self.kr.get_krow_2f(sw)
-
-    def get_krw(self, x, i1, j1, i2, j2):
-        c1 = self.get_cell_number(i1,j1)
-        c2 = self.get_cell_number(i2,j2)
-        if c1 == c2:
-            sw1 = x[c1*2-1]
-            return self.kr.get_krw_2f(sw1)
-        p1 = x[c1*2-2]
-        p2 = x[c2*2-2]
-        if (p1 > p2):
-            sw = x[c1*2-1]
-        else:
-            sw = x[c2*2-1]
-        return self.kr.get_krw_2f(sw)
-
-    def get_tr(self, x, i1, j1, i2, j2):
-        c1 = self.get_cell_number(i1,j1)
-        c2 = self.get_cell_number(i2,j2)
-        k1 = self._k_mat[i1,j1]
-        k2 = self._k_mat[i2,j2]
-        k = 2 * k1 * k2 / (k1 + k2)
-        if c1 == c2:
-            return 0., 0.
-        if i1 == i2:
-            tr = k * self._di_mat[i1,j1] * self.get_hk() / self._dj_mat[i1,j1]
+        x[::2] = self._get_cell_values(self._pr_mat)
+        x[1::2] = self._get_cell_values(self._sw_mat)
+        self._x_history = common.GrowingArray(self._nvars, dtype=self._history_dtype)
+        self._well_history = common.GrowingArray(3 * len(self._sim_wells))
+        self._n_linear_iter = 0
+        self._linear_iter_list = []
+        self.step_controller.reset()
+        self._append_solution(x)
+
+    def _append_solution(self, x):
+        self._x_last = x.copy()
+        self._x_history.append(x)
+        self._linear_iter_list.append(self._n_linear_iter)
+        qo, qw, bhp = self._get_all_well_rates(x)
+        self._well_history.append(np.column_stack([qo, qw, bhp]).ravel())
+
+    def _get_perf_mobility(self, kro, krw):
+        return _get_perf_mobility(self._perf_wi, kro, krw, self.get_bo() * self.get_uo(),
+                                  self.get_bw() * self.get_uw(), self._perf_is_prod)
+
+    def _get_perf_rate_split(self, lo, lw, perfs):
+        q = self._well_value[self._perf_well[perfs]] * self._perf_frac[perfs]
+        return _get_perf_rate_split(q, lo, lw, self._perf_is_prod[perfs])
+
+    def _get_all_well_rates(self, x):
+        # Rates are production positive here; injected water is reported positive.
+        cells = self._perf_cell
+        nwells = len(self._sim_wells)
+        pr = x[0::2][cells]
+        lo, lw = self._get_perf_mobility(*self._get_kr_cells(x[1::2][cells]))
+        value = self._get_perf_value()
+        qo = lo * (pr - value)
+        qw = lw * (pr - value)
+        rate = self._perf_rate
+        qo[rate], qw[rate] = self._get_perf_rate_split(lo[rate], lw[rate], rate)
+        qo = np.nan_to_num(np.bincount(self._perf_well, weights=qo, minlength=nwells))
+        qw = np.nan_to_num(np.bincount(self._perf_well, weights=qw, minlength=nwells))
+
+        lt = np.bincount(self._perf_well, weights=lo + lw, minlength=nwells)
+        lp = np.bincount(self._perf_well, weights=(lo + lw) * (pr - self._perf_head), minlength=nwells)
+        bhp = np.where(self._well_is_rate, (lp - qo - qw) / np.where(lt > 0., lt, np.nan), self._well_value)
+        qw = np.where(self._well_is_prod, qw, -qw)
+        return qo, qw, bhp
+
+    def _get_perf_value(self):
+        # BHP of each perforation: well value plus the wellbore head from the reference depth.
+        return self._well_value[self._perf_well] + self._perf_head
+
+    def _get_well_rates(self, x):
+        qo, qw, _ = self._get_all_well_rates(x)
+        return qo[self._prod_index], qw[self._prod_index]
+
+    def get_cell_number(self, i, j, k=0):
+        return i+1 + j * self.get_ni() + k * self.get_ni() * self.get_nj()
+
+    def _get_cell_values(self, mat):
+        return mat.flatten(order='F')
+
+    def _build_faces(self):
+        cells = np.arange(self._ncells).reshape((self.get_nk(), self.get_nj(), self.get_ni()))
+        ci1 = cells[:, :, :-1].ravel()
+        ci2 = cells[:, :, 1:].ravel()
+        cj1 = cells[:, :-1, :].ravel()
+        cj2 = cells[:, 1:, :].ravel()
+        ck1 = cells[:-1, :, :].ravel()
+        ck2 = cells[1:, :, :].ravel()
+        self._face_c1 = np.concatenate([ci1, cj1, ck1])
+        self._face_c2 = np.concatenate([ci2, cj2, ck2])
+        is_i = np.concatenate([np.ones(ci1.size, dtype=bool), np.zeros(cj1.size + ck1.size, dtype=bool)])
+        is_j = np.concatenate([np.zeros(ci1.size, dtype=bool), np.ones(cj1.size, dtype=bool), np.zeros(ck1.size, dtype=bool)])
+
+        k = self._get_cell_values(self._k_mat)
+        di = self._get_cell_values(self._di_mat)
+        dj = self._get_cell_values(self._dj_mat)
+        dk = self._get_cell_values(self._dk_mat)
+        c1 = self._face_c1
+        c2 = self._face_c2
+        if 'di' in self._arrays or 'dj' in self._arrays or 'dk' in self._arrays:
+            # Cell sizes vary: harmonic mean of the two half-cell transmissibilities.
+            perm = np.where(is_i | is_j, 1., self._kv_kh)
+            t1 = self._get_half_tr(k, di, dj, dk, c1, is_i, is_j) * perm
+            t2 = self._get_half_tr(k, di, dj, dk, c2, is_i, is_j) * perm
+            tr = t1 * t2 / (t1 + t2)
         else:
-            tr = k * self._dj_mat[i1,j1] * self.get_hk() / self._di_mat[i1,j1]
-        tro = unit_conv * tr * self.get_kro(x, i1, j1, i2, j2) / (self.get_bo() * self.get_uo())
-        trw = unit_conv * tr * self.get_krw(x, i1, j1, i2, j2) / (self.get_bw() * self.get_uw())
-        return tro, trw
+            k_face = 2 * k[c1] * k[c2] / (k[c1] + k[c2])
+            kv1 = self._kv_kh * k[c1]
+            kv2 = self._kv_kh * k[c2]
+            tr = np.where(is_i,
+                          k_face * dj[c1] * dk[c1] / di[c1],
+                          np.where(is_j,
+                                   k_face * di[c1] * dk[c1] / dj[c1],
+                                   2 * di[c1] * dj[c1] / (dk[c1] / kv1 + dk[c2] / kv2)))
+        self._face_tr = unit_conv * tr
+        self._face_dz = self._depth[c2] - self._depth[c1]
 
-    def build_k(self, x, dt):
-        k = np.zeros((self._nvars, self._nvars))
-        for j in range(self._nj):
-            for i in range(self._ni):
-                cell2 = []
-                if i > 0:
-                    cell2.append({'i':i-1,'j':j})
-                if i < (self.get_ni()-1):
-                    cell2.append({'i':i+1,'j':j})
-                if j > 0:
-                    cell2.append({'i':i,'j':j-1})
-                if j < (self.get_nj()-1):
-                    cell2.append({'i':i,'j':j+1})
-                p = self.get_cell_number(i,j)
-                for c in cell2:
-                    tro, trw = self.get_tr(x, i, j, c['i'], c['j'])
-                    p2 = self.get_cell_number(c['i'],c['j'])
-                    k[2*p-2,2*p-2] -= tro
-                    k[2*p-1,2*p-2] -= trw
-                    k[2*p-2,2*p2-2] = tro
-                    k[2*p-1,2*p2-2] = trw
-                vp_dt = self._di_mat[i,j] * self._dj_mat[i,j] * self.get_hk() * self._phi_mat[i,j] / dt
-                k[2*p-2,2*p-1] = vp_dt / self.get_bo()
-                k[2*p-1,2*p-1] = -1. * vp_dt / self.get_bw()
-        k[-2,-2] -= self._wi * self.get_kro(x, self.get_ni()-1, self.get_nj()-1, self.get_ni()-1, self.get_nj()-1) / (self.get_bo() * self.get_uo())
-        k[-1,-2] -= self._wi * self.get_krw(x, self.get_ni()-1, self.get_nj()-1, self.get_ni()-1, self.get_nj()-1) / (self.get_bw() * self.get_uw())
-        return k
-
-    def build_f(self, dt):
-        f = np.zeros((self._nvars, 1))
-        for j in range(self._nj):
-            for i in range(self._ni):
-                p = self.get_cell_number(i,j)
-                vp_dt = self._di_mat[i,j] * self._dj_mat[i,j] * self.get_hk() * self._phi_mat[i,j] / dt
-                sw_previous = self._x_list[-1][2*p-1]
-                f[2*p-2,0] = vp_dt / self.get_bo() * sw_previous
-                f[2*p-1,0] = -1. * vp_dt / self.get_bw() * sw_previous
-        f[1,0] -= self.get_qwi()
-        f[-2,0] -= self._wi * self.get_kro(self._x_list[-1], self.get_ni()-1, self.get_nj()-1, self.get_ni()-1, self.get_nj()-1) / (self.get_bo() * self.get_uo()) * self.get_pwf()
-        f[-1,0] -= self._wi * self.get_krw(self._x_list[-1], self.get_ni()-1, self.get_nj()-1, self.get_ni()-1, self.get_nj()-1) / (self.get_bw() * self.get_uw()) * self.get_pwf()
+        self._conn_c1 = np.concatenate([self._face_c1, self._face_c2])
+        self._conn_c2 = np.concatenate([self._face_c2, self._face_c1])
+        self._conn_tr = np.concatenate([self._face_tr, self._face_tr])
+        self._conn_dz = np.concatenate([self._face_dz, -self._face_dz])
+
+    def _get_half_tr(self, k, di, dj, dk, c, is_i, is_j):
+        return np.where(is_i, 2. * k[c] * dj[c] * dk[c] / di[c],
+                        np.where(is_j, 2. * k[c] * di[c] * dk[c] / dj[c],
+                                 2. * k[c] * di[c] * dj[c] / dk[c]))
+
+    def _get_connections(self):
+        return self._conn_c1, self._conn_c2, self._conn_tr
+
+    def _get_gravity(self):
+        if not self._gravity_on:
+            return ()
+        return self._gamma_o, self._gamma_w, self._conn_dz
+
+    def _get_upwind(self, pr):
+        c1, c2, _ = self._get_connections()
+        return _get_upwind(pr, c1, c2, *self._get_gravity())
+
+    def _get_phase_trs(self, kro, krw, up_o, up_w):
+        _, _, tr = self._get_connections()
+        return (_get_phase_tr(tr, kro, up_o, self.get_bo() * self.get_uo()),
+                _get_phase_tr(tr, krw, up_w, self.get_bw() * self.get_uw()))
+
+    def _get_potential_diff(self, pr):
+        # Phase potential difference from c1 to c2 along each connection.
+        c1, c2, _ = self._get_connections()
+        dp = pr[c2] - pr[c1]
+        if not self._gravity_on:
+            return dp, dp
+        return dp - self._gamma_o * self._conn_dz, dp - self._gamma_w * self._conn_dz
+
+    def build_g(self, x):
+        pr = x[0::2].ravel()
+        sw = x[1::2].ravel()
+        c1, _, _ = self._get_connections()
+        tro, trw = self._get_phase_trs(*self._get_kr_cells(sw), *self._get_upwind(pr))
+        return _get_g(tro, trw, c1, *self._get_gravity(), self._nvars)
+
+    def _build_rhs(self, dt, x, x_well=None):
+        f = self.build_f(dt, x_well)
+        if self._gravity_on:
+            f += self.build_g(x)
         return f
 
+    def _get_kr_cells(self, sw):
+        return self.kr.get_krow_2f_array(sw), self.kr.get_krw_2f_array(sw)
+
+    def _get_dkr_cells(self, sw):
+        return self.kr.get_dkrow_2f_array(sw), self.kr.get_dkrw_2f_array(sw)
+
+    def _get_k_index(self):
+        c1, c2, _ = self._get_connections()
+        cells = np.arange(self._ncells)
+        well = self._perf_cell[self._perf_bhp]
+        rows = np.concatenate([2*c1, 2*c1+1, 2*c1, 2*c1+1, 2*cells, 2*cells+1, 2*well, 2*well+1])
+        cols = np.concatenate([2*c1, 2*c1, 2*c2, 2*c2, 2*cells+1, 2*cells+1, 2*well, 2*well])
+        return rows, cols
+
+    def _get_k_triplets(self, x, dt):
+        pr = x[0::2].ravel()
+        sw = x[1::2].ravel()
+        kro, krw = self._get_kr_cells(sw)
+        tro, trw = self._get_phase_trs(kro, krw, *self._get_upwind(pr))
+        bhp = self._perf_bhp
+        lo, lw = self._get_perf_mobility(kro[self._perf_cell], krw[self._perf_cell])
+        rows, cols = self._get_k_index()
+        values = _get_k_values(tro, trw, self._pore_volume / dt, self.get_bo(), self.get_bw(), lo[bhp], lw[bhp])
+        return rows, cols, values
+
+    def build_k(self, x, dt):
+        rows, cols, values = self._get_k_triplets(x, dt)
+        return self.linear_solver.build_matrix(rows, cols, values, self._nvars)
+
+    def build_f(self, dt, x=None):
+        sw_previous = self._x_last[1::2]
+        if x is None:
+            sw_well = sw_previous[self._perf_cell]
+        else:
+            sw_well = x[1::2][self._perf_cell]
+        lo, lw = self._get_perf_mobility(*self._get_kr_cells(sw_well))
+        rate = self._perf_rate
+        bhp = self._perf_bhp
+        qo, qw = self._get_perf_rate_split(lo[rate], lw[rate], rate)
+        return _get_f(self._pore_volume / dt, sw_previous, self.get_bo(), self.get_bw(), self._perf_f_rows,
+                      qo, qw, lo[bhp], lw[bhp], self._get_perf_value()[bhp])
+
+    def build_jacobian(self, x, dt):
+        pr = x[0::2].ravel()
+        sw = x[1::2].ravel()
+        c1, c2, tr = self._get_connections()
+        dkro, dkrw = self._get_dkr_cells(sw)
+        up_o, up_w = self._get_upwind(pr)
+        dpo, dpw = self._get_potential_diff(pr)
+        dtro = tr * dkro[up_o] / (self.get_bo() * self.get_uo()) * dpo
+        dtrw = tr * dkrw[up_w] / (self.get_bw() * self.get_uw()) * dpw
+        well = self._perf_cell
+        lo, lw = self._get_perf_mobility(*self._get_kr_cells(sw[well]))
+        dlo, dlw = self._get_perf_mobility(dkro[well], dkrw[well])
+        is_rate = self._perf_is_rate
+        value = self._get_perf_value()
+        dp_well = np.where(is_rate, 0., pr[well] - value)
+        q = np.where(is_rate & self._perf_is_prod, self._well_value[self._perf_well] * self._perf_frac, 0.)
+        lt = lo + lw
+        dfo = (dlo * lw - lo * dlw) / np.where(lt > 0., lt * lt, 1.)
+
+        rows, cols, values = self._get_k_triplets(x, dt)
+        rows = np.concatenate([rows, 2*c1, 2*c1+1, 2*well, 2*well+1])
+        cols = np.concatenate([cols, 2*up_o+1, 2*up_w+1, 2*well+1, 2*well+1])
+        values = np.concatenate([values, dtro, dtrw,
+                                 -dlo * dp_well - q * dfo,
+                                 -dlw * dp_well + q * dfo])
+        return self.linear_solver.build_matrix(rows, cols, values, self._nvars)
+
     def build_r(self, x, dt):
         k = self.build_k(x, dt)
-        f = self.build_f(dt)
-        r = np.dot(k, x) - f
+        f = self._build_rhs(dt, x)
+        r = k.dot(x) - f
         return r
 
+    def build_r_implicit(self, x, dt):
+        k = self.build_k(x, dt)
+        f = self._build_rhs(dt, x, x)
+        return k.dot(x) - f
+
     def solve_next_dt(self, dt):
-        if len(self._x_list) == 0:
+        if len(self._t_list) == 0:
             self.initialize()
             self.start_simulation()
-        x = self._x_list[-1].copy()
+        n_linear_iter = self.linear_solver.get_n_linear_iter()
+        n_failed = self.linear_solver.get_n_failed()
+        if self._formulation == 'impes':
+            self._solve_impes(dt)
+        elif self._nonlinear_solver == 'newton':
+            self._solve_newton(dt)
+        else:
+            self._solve_picard(dt)
+        self._n_linear_iter = self.linear_solver.get_n_linear_iter() - n_linear_iter
+        # an unconverged iterative linear solve makes the whole time-step unreliable
+        n_failed = self.linear_solver.get_n_failed() - n_failed
+        if n_failed > 0 and self._converged_eq_system:
+            if self._debug:
+                print(f" {self._t_list[-1]:10.2f} days: {n_failed} linear solves didn't converge.")
+            self._converged_eq_system = False
+
+    def _solve_picard(self, dt):
+        x = self._x_last.copy()
         n = 0
         # r = self.build_r(x, dt)
-        while n < 50:
+        while n < self._max_iter:
             x_last = x.copy()
             k = self.build_k(x, dt)
-            f = self.build_f(dt)
-            x =  np.linalg.solve(k,f)
-
-            # if len(self._t_list) == 1:
-                # folder = ''
-                # np.savetxt(f'{folder}x_prev_{self.get_ni()}_{self.get_nj()}.csv', self._x_list[-1], delimiter=',')
-                # np.savetxt(f'{folder}f_{self.get_ni()}_{self.get_nj()}.csv', f, delimiter=',')
-                # np.savetxt(f'{folder}x_{self.get_ni()}_{self.get_nj()}.csv', x, delimiter=',')
-                # np.savetxt(f'{folder}k_{self.get_ni()}_{self.get_nj()}.csv', k, delimiter=',')
+            f = self._build_rhs(dt, x)
+            x = self.linear_solver.solve(k, f)
+
             # print(f'{n:2d}. error = {np.linalg.norm(x-x_last):0.3g}')
             if np.linalg.norm(x-x_last) < 0.01:
                 self._x_current = x
+                self._n_iter = n + 1
                 self._converged_eq_system = True
                 return
             n += 1
         if self._debug:
             print(f" {self._t_list[-1]:10.2f} days: Flow simulation didn't converge after {n} iterations. ||error|| = {np.linalg.norm(x-x_last):0.3g}")
         self._x_current = x
+        self._n_iter = n
         self._converged_eq_system = False
         return
 
+    def _solve_newton(self, dt):
+        x = self._x_last.copy()
+        r = self.build_r_implicit(x, dt)
+        r_norm = np.max(np.abs(r))
+        n = 0
+        while n < self._max_iter:
+            if r_norm < self._newton_tol:
+                self._x_current = x
+                self._n_iter = n
+                self._converged_eq_system = True
+                return
+            j = self.build_jacobian(x, dt)
+            dx = self.linear_solver.solve(j, -r)
+            max_dsw = np.max(np.abs(dx[1::2]))
+            if max_dsw > self._newton_max_dsw:
+                dx = dx * self._newton_max_dsw / max_dsw
+            alpha = 1.
+            while True:
+                x_new = x + alpha * dx
+                r_new = self.build_r_implicit(x_new, dt)
+                r_new_norm = np.max(np.abs(r_new))
+                if r_new_norm < r_norm or alpha < 0.1:
+                    break
+                alpha /= 2.
+            x = x_new
+            r = r_new
+            n += 1
+            if r_new_norm >= r_norm:
+                # backtracking failed: reject the step so that dt is cut
+                if self._debug:
+                    print(f" {self._t_list[-1]:10.2f} days: Newton line search failed. max|residual| = {r_new_norm:0.3g}")
+                self._x_current = x
+                self._n_iter = n
+                self._converged_eq_system = False
+                return
+            r_norm = r_new_norm
+        if self._debug:
+            print(f" {self._t_list[-1]:10.2f} days: Flow simulation didn't converge after {n} Newton iterations. max|residual| = {r_norm:0.3g}")
+        self._x_current = x
+        self._n_iter = n
+        self._converged_eq_system = False
+        return
+
+    def _get_impes_fluxes(self, sw, up):
+        kro, krw = self._get_kr_cells(sw)
+        tro, trw = self._get_phase_trs(kro, krw, *up)
+        wio, wiw = self._get_perf_mobility(kro[self._perf_cell], krw[self._perf_cell])
+        return tro, trw, wio, wiw
+
+    def _get_impes_well_flow(self, pr, wio, wiw):
+        # Volumetric (Bo qo + Bw qw) and water well rates, production positive, per perforation.
+        is_rate = self._perf_is_rate
+        value = self._get_perf_value()
+        qo, qw = self._get_perf_rate_split(wio, wiw, slice(None))
+        dp = pr[self._perf_cell] - value
+        q_t = np.where(is_rate, self.get_bo() * qo + self.get_bw() * qw, (self.get_bo() * wio + self.get_bw() * wiw) * dp)
+        q_w = np.where(is_rate, qw, wiw * dp)
+        return q_t, q_w
+
+    def _solve_impes_pressure(self, sw, up):
+        c1, c2, _ = self._get_connections()
+        tro, trw, wio, wiw = self._get_impes_fluxes(sw, up)
+        t = self.get_bo() * tro + self.get_bw() * trw
+        wi_t = self.get_bo() * wio + self.get_bw() * wiw
+        is_rate = self._perf_is_rate
+        bhp = ~is_rate
+        well = self._perf_cell
+        value = self._get_perf_value()
+        rows = np.concatenate([c1, c1, well[bhp]])
+        cols = np.concatenate([c1, c2, well[bhp]])
+        values = np.concatenate([-t, t, -wi_t[bhp]])
+        a = self.linear_solver.build_matrix(rows, cols, values, self._ncells)
+        b = np.zeros(self._ncells)
+        qo, qw = self._get_perf_rate_split(wio[is_rate], wiw[is_rate], is_rate)
+        np.add.at(b, well[is_rate], self.get_bo() * qo + self.get_bw() * qw)
+        np.subtract.at(b, well[bhp], wi_t[bhp] * value[bhp])
+        if self._gravity_on:
+            np.add.at(b, c1, (self.get_bo() * tro * self._gamma_o + self.get_bw() * trw * self._gamma_w) * self._conn_dz)
+        return self.linear_solver.solve(a, b)
+
+    def _solve_impes(self, dt):
+        pr_last = self._x_last[0::2]
+        sw_last = self._x_last[1::2]
+        c1, c2, _ = self._get_connections()
+        up = self._get_upwind(pr_last)
+        converged = False
+        n = 0
+        while n < self._max_iter:
+            pr = self._solve_impes_pressure(sw_last, up)
+            n += 1
+            up_new = self._get_upwind(pr)
+            if np.array_equal(up[0], up_new[0]) and np.array_equal(up[1], up_new[1]):
+                converged = True
+                break
+            up = up_new
+        if self._debug and not converged:
+            print(f" {self._t_list[-1]:10.2f} days: IMPES upwinding didn't settle after {n} pressure solutions.")
+        tro, trw, wio, wiw = self._get_impes_fluxes(sw_last, up)
+        _, q_w = self._get_impes_well_flow(pr, wio, wiw)
+        _, dpw = self._get_potential_diff(pr)
+        qw = np.zeros(self._ncells)
+        np.add.at(qw, c1, trw * dpw)
+        np.subtract.at(qw, self._perf_cell, q_w)
+        x = np.zeros(self._nvars)
+        x[0::2] = pr
+        sw = sw_last + dt * self.get_bw() / self._pore_volume * qw
+        # an explicit update outside the mobile range means dt is too large
+        sw_min = self.kr.sat.get_swi()
+        sw_max = 1. - self.kr.sat.get_sorw()
+        if np.any(sw < sw_min - 1e-10) or np.any(sw > sw_max + 1e-10):
+            converged = False
+        x[1::2] = np.clip(sw, sw_min, sw_max)
+        self._x_current = x
+        self._n_iter = n
+        self._converged_eq_system = converged
+
+    def get_cfl_dt(self):
+        if self._formulation != 'impes' or self._x_last is None:
+            return self._max_dt
+        pr = self._x_last[0::2]
+        sw = self._x_last[1::2]
+        c1, c2, tr = self._get_connections()
+        up = self._get_upwind(pr)
+        tro, trw, wio, wiw = self._get_impes_fluxes(sw, up)
+        q_t, _ = self._get_impes_well_flow(pr, wio, wiw)
+        q_out = np.zeros(self._ncells)
+        if self._gravity_on:
+            dpo, dpw = self._get_potential_diff(pr)
+            flux = -(self.get_bo() * tro * dpo + self.get_bw() * trw * dpw)
+        else:
+            flux = (self.get_bo() * tro + self.get_bw() * trw) * (pr[c1] - pr[c2])
+        np.add.at(q_out, c1, np.maximum(flux, 0.))
+        np.add.at(q_out, self._perf_cell, np.maximum(q_t, 0.))
+        kro, krw = self._get_kr_cells(sw)
+        dkro, dkrw = self._get_dkr_cells(sw)
+        lo = kro / self.get_uo()
+        lw = krw / self.get_uw()
+        dfw = (dkrw / self.get_uw() * lo - lw * dkro / self.get_uo()) / (lo + lw)**2
+        rate = q_out * np.abs(dfw) / self._pore_volume
+        if np.max(rate) <= 0.:
+            return self._max_dt
+        return min(self._cfl / np.max(rate), self._max_dt)
+
+    def limit_dt(self, dt):
+        if self._formulation != 'impes':
+            return dt
+        return max(min(dt, self.get_cfl_dt()), self._min_dt)
+
     def try_pwf(self, pwf, dt):
         self.set_pwf(pwf)
         self.solve_next_dt(dt)
-        pr = float(self._x_current[-2])
-        sw = float(self._x_current[-1])
-        qo = self._wi * self.kr.get_krow_2f(sw) / (self.get_bo() * self.get_uo()) * (pr - self.get_pwf())
-        qw = self._wi * self.kr.get_krw_2f(sw)  / (self.get_bw() * self.get_uw()) * (pr - self.get_pwf())
-        return qo, qw
+        return self._get_well_rates(self._x_current)
+
+    def propose(self, pwf, dt):
+        # the proposed time-step is pending until commit() or rollback()
+        rates = self.try_pwf(pwf, dt)
+        self._proposed_dt = dt
+        return rates
+
+    def get_proposed_dt(self):
+        return self._proposed_dt
+
+    def snapshot(self):
+        return {'x': self._x_current.copy(),
+                'pwf': self.get_pwf(),
+                'dt': self._proposed_dt,
+                'rates': self._get_well_rates(self._x_current),
+                'n_iter': self._n_iter,
+                'n_linear_iter': self._n_linear_iter,
+                'converged': self._converged_eq_system}
+
+    def restore(self, state):
+        self._x_current = state['x']
+        self.set_pwf(state['pwf'])
+        self._proposed_dt = state['dt']
+        self._n_iter = state['n_iter']
+        self._n_linear_iter = state['n_linear_iter']
+        self._converged_eq_system = state['converged']
+
+    def commit(self, dt=None):
+        if dt is None:
+            dt = self._proposed_dt
+        if dt is None:
+            raise ValueError('No proposed time-step to commit. Call propose() or give dt.')
+        dt = min(dt, self._t_end - self._t_list[-1])
+        self._append_solution(self._x_current)
+        self._t_list.append(min(self._t_list[-1] + dt, self._t_end))
+        self._proposed_dt = None
+
+    def rollback(self):
+        self._x_current = self._x_last.copy()
+        self._converged_eq_system = True
+        self._proposed_dt = None
+
+    def build_well_response(self, dt, x=None):
+        if x is None:
+            x = self._x_current
+        pwf = self.get_pwf()
+        k = self.build_k(x, dt)
+        self.set_pwf(0.)
+        f0 = self.build_f(dt)
+        self.set_pwf(1.)
+        f1 = self.build_f(dt) - f0
+        self.set_pwf(pwf)
+        if self._gravity_on:
+            f0 += self.build_g(x)
+        n_failed = self.linear_solver.get_n_failed()
+        x = self.linear_solver.solve(k, np.column_stack([f0, f1]))
+        if self.linear_solver.get_n_failed() > n_failed:
+            self._response_key = None
+            return
+        self._response_x0 = x[:, 0]
+        self._response_x1 = x[:, 1]
+        self._response_key = (dt, len(self._t_list))
+
+    def try_pwf_response(self, pwf, dt):
+        if len(self._t_list) == 0:
+            self.initialize()
+            self.start_simulation()
+        if self._formulation == 'impes':
+            return self.try_pwf(pwf, dt)
+        if self._response_key != (dt, len(self._t_list)):
+            rates = self.try_pwf(pwf, dt)
+            # only a converged trial gives mobilities worth freezing; otherwise the next call solves again
+            if self._converged_eq_system:
+                self.build_well_response(dt)
+            return rates
+        self.set_pwf(pwf)
+        self._x_current = self._response_x0 + pwf * self._response_x1
+        return self._get_well_rates(self._x_current)
 
     def run_simulation(self, dt, add_current_solution=False):
         if (len(self._t_list) == 0):
@@ -340,21 +1134,21 @@ class Simple2D_OW:
             progress_bar = tqdm(total=100, desc="Progress", bar_format="{percentage:3.0f}% {elapsed} {bar}")
         t = self._t_list[-1]
         while t < self._t_end:
-            dti = min(dt, self._t_end - self._t_list[-1])
+            dti = min(self.limit_dt(dt), self._t_end - self._t_list[-1])
             if not add_current_solution:
                 self.solve_next_dt(dti)
             if add_current_solution or self.check_convergence(dti):
-                self._x_list.append(self._x_current)
-                t = min(self._t_list[-1] + dti, self._t_end)
-                self._t_list.append(t)
+                error = self.get_step_error()
+                self.commit(dti)
+                t = self._t_list[-1]
                 if add_current_solution:
                     return
                 percentage_completion = min(0.999, t / self._t_end) * 100
                 if not add_current_solution:
                     progress_bar.update(percentage_completion - progress_bar.n)
-                dt = min(dt * 1.2, self._max_dt)
+                dt = min(self.step_controller.accept(dt, error), self._max_dt)
             else:
-                dt = max(dti / 2., self._min_dt)
+                dt = max(self.step_controller.reject(dti, self.get_step_error()), self._min_dt)
                 if self._debug:
                     print(f" {self._t_list[-1]:10.2f} days: time-step cut. New dt = {dt:10.5f} days")
 
@@ -371,44 +1165,65 @@ class Simple2D_OW:
         out.extend(dt)
         return out
 
-    def get_sw_cell(self,i , j):
-        p = self.get_cell_number(i, j)
-        sw = [x[2*p-1] for x in self._x_list]
-        sw = [float(sw) for sw in sw]
-        return sw
-
-    def get_pr_cell(self,i , j):
-        p = self.get_cell_number(i, j)
-        pr = [x[2*p-2] for x in self._x_list]
-        pr = [float(pr) for pr in pr]
-        return pr
-
-    def get_well_qo(self):
-        sw = self.get_sw_cell(self.get_ni()-1, self.get_nj()-1)
-        pr = self.get_pr_cell(self.get_ni()-1, self.get_nj()-1)
-        qo = [self._wi * self.kr.get_krow_2f(s) / (self.get_bo() * self.get_uo()) * (p - self.get_pwf()) for p,s in zip(pr, sw)]
-        qo = [float(q) for q in qo]
-        return qo
-
-    def get_well_qw(self):
-        sw = self.get_sw_cell(self.get_ni()-1, self.get_nj()-1)
-        pr = self.get_pr_cell(self.get_ni()-1, self.get_nj()-1)
-        qw = [self._wi * self.kr.get_krw_2f(s) / (self.get_bw() * self.get_uw()) * (p - self.get_pwf()) for p,s in zip(pr, sw)]
-        qw = [float(q) for q in qw]
-        return qw
-
-    def get_inj_pwf(self):
-        sw = self.get_sw_cell(0, 0)[-1]
-        pr = self.get_pr_cell(0, 0)[-1]
-        return pr + self.get_qwi() * self.get_bw() * self.get_uw() / (self._wi_inj * self.kr.get_krw_2f(sw))
-
-    def get_pr_map(self, t_index):
-        x = self._x_list[t_index]
-        return x[::2].flatten().reshape((self.get_ni(),self.get_nj()))
-
-    def get_sw_map(self, t_index):
-        x = self._x_list[t_index]
-        return x[1::2].flatten().reshape((self.get_ni(),self.get_nj()))
+    def get_sw_cell(self,i , j, k=0):
+        p = self.get_cell_number(i, j, k)
+        return self._x_history.get_column(2*p-1).astype(float).tolist()
+
+    def get_pr_cell(self,i , j, k=0):
+        p = self.get_cell_number(i, j, k)
+        return self._x_history.get_column(2*p-2).astype(float).tolist()
+
+    def _get_well_column(self, name, default, kind='producer'):
+        if name is None:
+            if default is None:
+                raise NameError(f'No {kind} defined. Give the well name. Valid wells: {[w.get_name() for w in self.get_wells()]}.')
+            return default
+        return self.get_wells().index(self.get_well(name))
+
+    def get_well_qo(self, name=None):
+        w = self._get_well_column(name, self._prod_index)
+        return self._well_history.get_column(3*w).tolist()
+
+    def get_well_qw(self, name=None):
+        w = self._get_well_column(name, self._prod_index)
+        return self._well_history.get_column(3*w+1).tolist()
+
+    def get_well_bhp(self, name=None):
+        w = self._get_well_column(name, self._prod_index)
+        return self._well_history.get_column(3*w+2).tolist()
+
+    def get_last_well_rates(self, name=None):
+        w = self._get_well_column(name, self._prod_index)
+        qo, qw = self._well_history[-1][3*w:3*w+2]
+        return float(qo), float(qw)
+
+    def get_inj_pwf(self, name=None):
+        w = self._get_well_column(name, self._inj_index, 'injector')
+        _, _, bhp = self._get_all_well_rates(self._x_last)
+        return float(bhp[w])
+
+    def _get_map(self, values, k):
+        # layer k as an [i, j] array, the layout of set_*_array() and load_property()
+        n = self.get_ni() * self.get_nj()
+        return values[k*n:(k+1)*n].reshape((self.get_ni(), self.get_nj()), order='F')
+
+    def get_pr_map(self, t_index, k=0):
+        return self._get_map(self._x_history[t_index][::2].astype(float), k)
+
+    def get_sw_map(self, t_index, k=0):
+        return self._get_map(self._x_history[t_index][1::2].astype(float), k)
+
+    def get_step_error(self):
+        error = None
+        if self._max_dpr is not None:
+            max_dpr = np.max(np.abs(self._x_last[::2] - self._x_current[::2]))
+            error = max_dpr / self._max_dpr
+        if self._max_dsw is not None:
+            max_dsw = np.max(np.abs(self._x_last[1::2] - self._x_current[1::2]))
+            error = max_dsw / self._max_dsw if error is None else max(error, max_dsw / self._max_dsw)
+        if self._target_iter is not None:
+            error = self._n_iter / self._target_iter if error is None else max(error, self._n_iter / self._target_iter)
+        return error
 
     def check_convergence(self, dt = None):
         if dt is not None:
@@ -420,17 +1235,229 @@ class Simple2D_OW:
             return False
 
         if self._max_dpr is not None:
-            last_pr = self._x_list[-1][::2].flatten()
+            last_pr = self._x_last[::2]
             curr_pr = self._x_current[::2].flatten()
             max_dpr = np.max(np.abs(last_pr - curr_pr))
             if max_dpr > self._max_dpr:
                 return False
 
         if self._max_dsw is not None:
-            last_sw = self._x_list[-1][1::2].flatten()
+            last_sw = self._x_last[1::2]
             curr_sw = self._x_current[1::2].flatten()
             max_dsw = np.max(np.abs(last_sw - curr_sw))
             if max_dsw > self._max_dsw:
                 return False
 
         return True
+
+class Ensemble:
+
+    def __init__(self, debug=False):
+        self._models = []
+        self._debug = debug
+        self._t_list = []
+        self.step_controller = time_step.StepController()
+
+    def add_model(self, model):
+        if self._t_list:
+            raise ValueError('Models can not be added after the ensemble simulation started.')
+        self._models.append(model)
+    def reset_models(self):
+        self._models = []
+        self._t_list = []
+
+    def get_models(self):
+        return self._models
+    def get_model(self, index):
+        return self._models[index]
+    def get_n_models(self):
+        return len(self._models)
+    def get_t(self):
+        return self._t_list
+
+    def _start(self):
+        for model in self._models:
+            if len(model.get_t()) == 0:
+                model.initialize()
+                model.start_simulation()
+        nvars = {model._nvars for model in self._models}
+        if len(nvars) > 1:
+            raise ValueError(f'All models in the ensemble must have the same number of unknowns. Found: {sorted(nvars)}.')
+        for model in self._models[1:]:
+            if model.get_t_end() != self._models[0].get_t_end() or model.get_t()[-1] != self._models[0].get_t()[-1]:
+                raise ValueError('All models in the ensemble must have the same simulation time and end time.')
+        self._prepare()
+        self.step_controller.reset()
+        self._t_list = list(self._models[0].get_t())
+
+    def _prepare(self):
+        # models must share the grid and the well perforations; everything else is stacked per model
+        models = self._models
+        m0 = models[0]
+        # settings the ensemble does not follow must not be set differently in a model
+        for m, model in enumerate(models):
+            if model.get_formulation() != 'implicit' or model.get_nonlinear_solver() != 'picard':
+                raise ValueError(f'Model {m} uses the {model.get_formulation()} formulation with the {model.get_nonlinear_solver()} solver. '
+                                 'The ensemble runs the implicit formulation with the picard solver.')
+            if model.linear_solver.get_method() != 'dense':
+                raise ValueError(f'Model {m} uses the {model.linear_solver.get_method()} linear solver. The ensemble uses stacked dense solves.')
+            if (model.get_max_iter(), model.get_max_dt(), model.get_min_dt()) != (m0.get_max_iter(), m0.get_max_dt(), m0.get_min_dt()):
+                raise ValueError(f'Model {m} has max_iter, max_dt or min_dt different from model 0. The ensemble uses the same values for all models.')
+        c1, c2, _ = m0._get_connections()
+        for model in models[1:]:
+            mc1, mc2, _ = model._get_connections()
+            same = (np.array_equal(c1, mc1) and np.array_equal(c2, mc2)
+                    and np.array_equal(m0._perf_cell, model._perf_cell)
+                    and np.array_equal(m0._perf_well, model._perf_well)
+                    and np.array_equal(m0._perf_is_prod, model._perf_is_prod)
+                    and np.array_equal(m0._perf_is_rate, model._perf_is_rate))
+            if not same:
+                raise ValueError('All models in the ensemble must have the same grid and wells.')
+        self._c1 = c1
+        self._c2 = c2
+        self._tr = np.array([model._get_connections()[2] for model in models])
+        self._pore_volume = np.array([model._pore_volume for model in models])
+        self._bo = np.array([[model.get_bo()] for model in models])
+        self._bw = np.array([[model.get_bw()] for model in models])
+        self._bo_uo = np.array([[model.get_bo() * model.get_uo()] for model in models])
+        self._bw_uw = np.array([[model.get_bw() * model.get_uw()] for model in models])
+        self._perf_wi = np.array([model._perf_wi for model in models])
+        self._perf_q = np.array([model._well_value[model._perf_well] * model._perf_frac for model in models])
+        self._perf_value = np.array([model._get_perf_value() for model in models])
+        self._gravity_on = any(model._gravity_on for model in models)
+        if self._gravity_on:
+            self._gamma_o = np.array([[model._gamma_o if model._gravity_on else 0.] for model in models])
+            self._gamma_w = np.array([[model._gamma_w if model._gravity_on else 0.] for model in models])
+            self._dz = np.array([model._conn_dz for model in models])
+        self._kr_params = None
+        if all(type(model.kr) is relative_permeability.Corey for model in models):
+            kr = [model.kr for model in models]
+            self._kr_params = {
+                'swi': np.array([[k.sat.get_swi()] for k in kr]),
+                'swc': np.array([[k.sat.get_swc()] for k in kr]),
+                'sorw': np.array([[k.sat.get_sorw()] for k in kr]),
+                'kro_max': np.array([[k.get_kro_max()] for k in kr]),
+                'krw_max': np.array([[k.get_krw_max()] for k in kr]),
+                'now': np.array([[k.get_now()] for k in kr]),
+                'nw': np.array([[k.get_nw()] for k in kr])}
+
+        n = m0._nvars
+        rows, cols = m0._get_k_index()
+        self._k_index = np.arange(len(models))[:, np.newaxis] * n * n + rows * n + cols
+
+    def _get_kr(self, sw, active):
+        if self._kr_params is None:
+            kr = [self._models[m].kr for m in active]
+            kro = np.array([k.get_krow_2f_array(s) for k, s in zip(kr, sw)])
+            krw = np.array([k.get_krw_2f_array(s) for k, s in zip(kr, sw)])
+            return kro, krw
+        p = {name: value[active] for name, value in self._kr_params.items()}
+        kro = relative_permeability.krow_Corey(sw, p['swi'], p['sorw'], p['kro_max'], p['now'])
+        krw = relative_permeability.krw_Corey(sw, p['swc'], p['sorw'], p['krw_max'], p['nw'])
+        return kro, krw
+
+    def _get_gravity(self, active):
+        if not self._gravity_on:
+            return ()
+        return self._gamma_o[active], self._gamma_w[active], self._dz[active]
+
+    def _build_system(self, x, x_last, dt, active):
+        # Simple2D_OW._get_k_triplets and _build_rhs with a leading model axis
+        m0 = self._models[0]
+        nact = len(active)
+        n = x.shape[1]
+        pr = x[:, 0::2]
+        sw = x[:, 1::2]
+        gravity = self._get_gravity(active)
+        kro, krw = self._get_kr(sw, active)
+        up_o, up_w = _get_upwind(pr, self._c1, self._c2, *gravity)
+        tr = self._tr[active]
+        bo_uo = self._bo_uo[active]
+        bw_uw = self._bw_uw[active]
+        tro = _get_phase_tr(tr, kro, up_o, bo_uo)
+        trw = _get_phase_tr(tr, krw, up_w, bw_uw)
+        vp_dt = self._pore_volume[active] / dt
+        bo = self._bo[active]
+        bw = self._bw[active]
+        is_prod = m0._perf_is_prod
+        bhp = m0._perf_bhp
+        rate = m0._perf_rate
+        cells = m0._perf_cell
+        wi = self._perf_wi[active]
+        lo, lw = _get_perf_mobility(wi, kro[:, cells], krw[:, cells], bo_uo, bw_uw, is_prod)
+        values = _get_k_values(tro, trw, vp_dt, bo, bw, lo[:, bhp], lw[:, bhp])
+        k = np.bincount(self._k_index[:nact].ravel(), weights=values.ravel(), minlength=nact * n * n)
+
+        # wells in the right-hand side use the saturation of the last time-step
+        sw_previous = x_last[:, 1::2]
+        lo, lw = _get_perf_mobility(wi, *self._get_kr(sw_previous[:, cells], active), bo_uo, bw_uw, is_prod)
+        qo, qw = _get_perf_rate_split(self._perf_q[active][:, rate], lo[:, rate], lw[:, rate], is_prod[rate])
+        f = _get_f(vp_dt, sw_previous, bo, bw, m0._perf_f_rows,
+                   qo, qw, lo[:, bhp], lw[:, bhp], self._perf_value[active][:, bhp])
+        if self._gravity_on:
+            f += _get_g(tro, trw, self._c1, *gravity, n)
+        return k.reshape((nact, n, n)), f
+
+    def _solve_picard(self, dt):
+        models = self._models
+        x_last = np.array([model._x_last for model in models])
+        x = x_last.copy()
+        active = np.arange(len(models))
+        n_iter = np.zeros(len(models), dtype=int)
+        converged = np.zeros(len(models), dtype=bool)
+        n = 0
+        while n < models[0].get_max_iter() and active.size > 0:
+            x_active = x[active]
+            k, f = self._build_system(x_active, x_last[active], dt, active)
+            x_new = np.linalg.solve(k, f[:, :, np.newaxis])[:, :, 0]
+            x[active] = x_new
+            n += 1
+            n_iter[active] = n
+            done = np.linalg.norm(x_new - x_active, axis=1) < 0.01
+            converged[active[done]] = True
+            active = active[~done]
+        for m, model in enumerate(models):
+            model._x_current = x[m]
+            model._n_iter = n_iter[m]
+            model._n_linear_iter = 0
+            model._converged_eq_system = converged[m]
+            if self._debug and not converged[m]:
+                print(f" {self._t_list[-1]:10.2f} days: Flow simulation of model {m} didn't converge after {n_iter[m]} iterations.")
+
+    def _get_step_error(self):
+        errors = [model.get_step_error() for model in self._models]
+        errors = [e for e in errors if e is not None]
+        return max(errors) if errors else None
+
+    def run_simulation(self, dt):
+        if len(self._models) == 0:
+            return
+        self._start()
+        model = self._models[0]
+        progress_bar = tqdm(total=100, desc="Progress", bar_format="{percentage:3.0f}% {elapsed} {bar}")
+        t_end = model.get_t_end()
+        while self._t_list[-1] < t_end:
+            dti = min(dt, t_end - self._t_list[-1])
+            self._solve_picard(dti)
+            if all(m.check_convergence(dti) for m in self._models):
+                error = self._get_step_error()
+                for m in self._models:
+                    m.commit(dti)
+                self._t_list.append(model.get_t()[-1])
+                progress_bar.update(min(0.999, self._t_list[-1] / t_end) * 100 - progress_bar.n)
+                dt = min(self.step_controller.accept(dt, error), model.get_max_dt())
+            else:
+                dt = max(self.step_controller.reject(dti, self._get_step_error()), model.get_min_dt())
+                if self._debug:
+                    print(f" {self._t_list[-1]:10.2f} days: time-step cut. New dt = {dt:10.5f} days")
+        progress_bar.close()
+        print("End of simulation.")
+
+    def get_well_qo(self, name=None):
+        return np.array([model.get_well_qo(name) for model in self._models])
+
+    def get_well_qw(self, name=None):
+        return np.array([model.get_well_qw(name) for model in self._models])
+
+    def get_well_bhp(self, name=None):
+        return np.array([model.get_well_bhp(name) for model in self._models])
@@ -0,0 +1,88 @@
+class StepController:
+
+    def __init__(self):
+        self._methods = ['simple', 'pi']
+        self._method = 'simple'
+        self._growth = 1.2
+        self._cut = 0.5
+        self._target = 0.8
+        self._ki = 0.3
+        self._kp = 0.4
+        self._max_growth = 2.
+        self._min_factor = 0.2
+        self._last_error = None
+        self._failed_dt = None
+        self._n_accepted = 0
+        self._n_rejected = 0
+
+    def set_method(self, method):
+        if method.lower() not in self._methods:
+            raise NameError(f'Unknown time-step controller ({method}). Valid controllers: {self._methods}.')
+        self._method = method.lower()
+    def set_growth(self, value):
+        self._growth = value
+    def set_cut(self, value):
+        self._cut = value
+    def set_target(self, value):
+        self._target = value
+    def set_ki(self, value):
+        self._ki = value
+    def set_kp(self, value):
+        self._kp = value
+    def set_max_growth(self, value):
+        self._max_growth = value
+    def set_min_factor(self, value):
+        self._min_factor = value
+
+    def get_method(self):
+        return self._method
+    def get_growth(self):
+        return self._growth
+    def get_cut(self):
+        return self._cut
+    def get_target(self):
+        return self._target
+    def get_ki(self):
+        return self._ki
+    def get_kp(self):
+        return self._kp
+    def get_max_growth(self):
+        return self._max_growth
+    def get_min_factor(self):
+        return self._min_factor
+    def get_n_accepted(self):
+        return self._n_accepted
+    def get_n_rejected(self):
+        return self._n_rejected
+
+    def reset(self):
+        self._last_error = None
+        self._failed_dt = None
+        self._n_accepted = 0
+        self._n_rejected = 0
+
+    def _limit(self, factor):
+        return min(max(factor, self._min_factor), self._max_growth)
+
+    def accept(self, dt, error=None):
+        self._n_accepted += 1
+        if self._method == 'simple' or error is None:
+            self._last_error = error
+            return dt * self._growth
+        error = max(error, 1e-10)
+        factor = (self._target / error) ** self._ki
+        if self._last_error is not None:
+            factor *= (max(self._last_error, 1e-10) / error) ** self._kp
+        self._last_error = error
+        dt_new = dt * self._limit(factor)
+        if self._failed_dt is not None:
+            dt_new = min(dt_new, max(dt, self._target * self._failed_dt))
+            self._failed_dt = None
+        return dt_new
+
+    def reject(self, dt, error=None):
+        self._n_rejected += 1
+        if self._method == 'simple' or error is None:
+            return dt * self._cut
+        self._failed_dt = dt
+        return dt * min(self._limit(self._target / max(error, 1e-10)), self._cut)
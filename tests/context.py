@@ -10,3 +10,4 @@ import reservoir
 import topside
 import integrated_model
 import common
+import linear_solver
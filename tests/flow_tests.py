@@ -410,6 +410,51 @@ def system_ex1_vfp():
                 'Length [m]', 'Head loss / linear distance [m/100 m]',
                 'System with 3 Elements', 'system1_hl')
 
+def system_ex1_vlp_table():
+    print('System with 3 Elements - VLP table')
+
+    line = define_system_ex1(debug_mode=False)
+    line.set_p_out(10.)
+    line.set_t_out(50.)
+    line.ipr.set_pi(40.)
+    line.ipr.set_pr(340.)
+
+    line.build_vlp([100. + 300.*i for i in range(14)], [0.], [5., 10., 15.])
+    for q in [250., 1234., 3210.]:
+        line.set_q_std(q)
+        line.solve_in_flow()
+        pwf_table = line.get_vlp().get_pwf(q, 0., 10.)
+        print(f'  q = {q:.1f} m3/d: Pwf = {line.get_p_in()[0]:.3f} bar, table = {pwf_table:.3f} bar')
+
+    line.solve_operation_point()
+    print(f'  Operation point: pwf = {line.get_pwf():.3f} bar, q = {line.ipr.get_q(line.get_pwf()):.3f} m3/d')
+
+    # the table was built for the old ESP; changing it must drop the table
+    pwf = line.get_pwf()
+    line.set_esp_delta_p(80.)
+    assert line.get_vlp() is None, 'changing the ESP kept the VLP table'
+    line.solve_operation_point()
+    assert line.get_pwf() < pwf, 'a larger ESP delta p did not lower the operation point Pwf'
+    print(f'  ESP delta p = 80 bar: pwf = {line.get_pwf():.3f} bar, q = {line.ipr.get_q(line.get_pwf()):.3f} m3/d')
+
+def system_ex1_root_methods():
+    print('System with 3 Elements - Operation point methods')
+
+    line = define_system_ex1(debug_mode=False)
+    line.set_p_out(10.)
+    line.set_t_out(50.)
+    line.ipr.set_pi(40.)
+    line.ipr.set_pr(340.)
+
+    for method in ['secant', 'bracket']:
+        line.set_root_method(method)
+        pwf = 300.
+        for pi in [40., 35., 30.]:
+            line.ipr.set_pi(pi)
+            line.solve_operation_point(pwf)
+            pwf = line.get_pwf()
+            print(f'  {method}, PI = {pi:.0f}: pwf = {line.get_pwf():.6f} bar, evaluations = {line.get_n_eval()}')
+
 def system_ex1_sensibility():
     print('System with 3 Elements - Sensibility')
 
@@ -545,6 +590,8 @@ if __name__ == "__main__":
 
     system_ex1_emulsion()
     system_ex1_vfp()
+    system_ex1_vlp_table()
+    system_ex1_root_methods()
     system_ex1_sensibility()
 
     system_ex2(4.)
@@ -1,4 +1,6 @@
 import os
+import time
+import numpy as np
 from context import integrated_model
 import matplotlib.pyplot as plt
 
@@ -221,5 +223,79 @@ def test1():
         model.reservoir.set_first_cell_dsw(i/100.)
         model.run_simulation(0.5, False)
 
+def define_integration(t_end=365.):
+    model = integrated_model.Integration(debug=False)
+    model.set_out_folder(path+'/plots/integration/')
+
+    set_pvt(model.pvt)
+    set_reservoir(model.reservoir)
+
+    set_system_prod(model.flow_prod)
+    model.flow_prod.set_esp_delta_p(50.)
+    model.flow_prod.set_esp_eff(0.6)
+    model.flow_prod.set_esp_eff_coef(200.)
+
+    set_system_inj(model.flow_inj)
+
+    model.water_pump.set_eff(0.75)
+
+    model.gas_compressor.set_eff(0.76)
+    model.gas_compressor.set_k(1.4)
+    model.gas_compressor.set_p_out(120.)
+
+    model.set_gas_loss(0.02)
+
+    model.emission.set_mole_pc('co2', 0.8 )
+    model.emission.set_mole_pc('ch4', 95.3)
+    model.emission.set_mole_pc('c2h6', 1.7)
+    model.emission.set_mole_pc('c3h8', 0.5)
+    model.emission.set_mole_pc('c4h10', 0.1)
+    model.emission.set_mole_pc('n2', 1.6)
+    model.emission.generator.set_power([0, 0.1, 10, 20, 40, 100])
+    model.emission.generator.set_fuel([0, 65000, 75000, 126000, 250000, 750000])
+
+    model.set_reservoir_t(50.)
+    model.set_reservoir_p(340.)
+    model.set_well_head_t(50.)
+    model.set_well_head_p(20.)
+
+    model.set_file_name('results_main.txt')
+    model.reservoir.set_t_end(t_end)
+    return model
+
+def sweep_test(workers=None):
+    sweep = integrated_model.ScenarioSweep(define_integration)
+    sweep.set_workers(workers)
+    sweep.add_grid({'well_head_p': [15., 20., 25.],
+                    'flow_prod.esp_delta_p': [0., 50., 100.]})
+    sweep.add_scenario({'reservoir.qwi': 800.})
+    sweep.add_scenario({'gas_loss': 0.05})
+    sweep.add_scenario({'flow_prod.d_elements': 6 * 2.54/100.})
+    start = time.time()
+    results = sweep.run(0.5)
+    print(f'{len(sweep.get_scenarios())} scenarios in {time.time() - start:.2f} s')
+    for n, overrides in enumerate(sweep.get_scenarios()):
+        rows = results['scenario'] == n
+        t = results['t'][rows]
+        qo = results['qo'][rows]
+        oil = np.sum(qo[1:] * np.diff(t))
+        print(f'  {overrides}: Np = {oil:.0f} m3, CO2 = {results["cumulative_emission"][rows][-1]/1000.:.0f} ton')
+    assert len(sweep.get_scenarios()) == 12 and np.array_equal(np.unique(results['scenario']), np.arange(12))
+    assert all(np.all(np.isfinite(results[name])) for name in sweep.get_result_names()), 'sweep results are not finite'
+
+    # a scenario of the sweep gives the same results as the model set up and run directly
+    n = sweep.get_scenarios().index({'well_head_p': 25., 'flow_prod.esp_delta_p': 100.})
+    model = define_integration()
+    model.set_well_head_p(25.)
+    model.flow_prod.set_esp_delta_p(100.)
+    model.set_file_name(None)
+    model.run_simulation(0.5, make_plots=False, show_progress=False)
+    direct = model.get_results(sweep.get_result_names())
+    rows = results['scenario'] == n
+    for name in sweep.get_result_names():
+        assert np.array_equal(results[name][rows], direct[name]), f'sweep {name} differs from the direct run'
+    print('  Scenario results match a direct run (ok)')
+
 if __name__ == "__main__":
     test1()
+    sweep_test()
@@ -1,4 +1,6 @@
 import os
+import time
+import numpy as np
 from context import relative_permeability as kr
 from context import common
 import matplotlib.pyplot as plt
@@ -73,8 +75,41 @@ def kr_oil_water_corey():
     plt.title('Corey')
     save_plot(plt,'corey_prime')
 
+def kr_corey_array(n=100000):
+    rel_perm = kr.Corey()
+    rel_perm.sat.set_swi(0.10)
+    rel_perm.sat.set_swc(0.20)
+    rel_perm.sat.set_sorw(0.16)
+    rel_perm.set_nw(2.0)
+    rel_perm.set_now(3.0)
+    rel_perm.set_krw_max(0.63)
+    rel_perm.set_kro_max(0.9)
+
+    sw = np.concatenate([np.linspace(0., 1., n), [0.1, 0.2, 0.84, 0.9]])
+    funcs = [('Krw', rel_perm.get_krw_2f, rel_perm.get_krw_2f_array),
+             ('Krow', rel_perm.get_krow_2f, rel_perm.get_krow_2f_array),
+             ('dKrw', rel_perm.get_dkrw_2f, rel_perm.get_dkrw_2f_array),
+             ('dKrow', rel_perm.get_dkrow_2f, rel_perm.get_dkrow_2f_array)]
+    for name, f_scalar, f_array in funcs:
+        t0 = time.time()
+        kr_scalar = np.array([f_scalar(s) for s in sw])
+        t1 = time.time()
+        kr_array = f_array(sw)
+        t2 = time.time()
+        n_diff = np.count_nonzero(kr_scalar != kr_array)
+        print(f'{name}: {n_diff} of {sw.size} values differ from the scalar method, scalar {t1-t0:.4f} s, array {t2-t1:.4f} s')
+        assert n_diff == 0, f'{name} array values are not identical to the scalar method'
+
+    # one exponent per row, as the reservoir Ensemble uses them
+    nw = np.array([[1.5], [2.5]])
+    kr_rows = kr.krw_Corey(np.tile(sw, (2, 1)), rel_perm.sat.get_swc(), rel_perm.sat.get_sorw(), rel_perm.get_krw_max(), nw)
+    for row, n_row in zip(kr_rows, nw[:, 0]):
+        rel_perm.set_nw(n_row)
+        assert np.array_equal(row, [rel_perm.get_krw_2f(s) for s in sw]), f'Krw with nw = {n_row} is not identical to the scalar method'
+    print('Krw with one nw per row: identical to the scalar method')
 
 
 if __name__ == "__main__":
     kr_oil_water_corey()
+    kr_corey_array()
     pass
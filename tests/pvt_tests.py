@@ -1,4 +1,5 @@
 import os
+import numpy as np
 from context import pvt
 import matplotlib.pyplot as plt
 
@@ -416,6 +417,82 @@ def u_emulssion_test():
     plt.title(f'U with Emulsion @{pvt1.get_p()} bar')
     save_plot(plt,'u_emulsion')
 
+def cache_test():
+    pvt1 = pvt.PVT()
+    pvt1.set_api(15.)
+    pvt1.set_dg(0.8)
+    pvt1.set_gor(20.)
+    pvt2 = pvt1.copy()
+    pvt2.set_cache(max_size=1000, dp=0.01)
+
+    p = [100. + 0.001 * (i % 500) for i in range(5000)]
+    max_error = 0.
+    for pi in p:
+        pvt1.update_bo_Standing(pi, 50.)
+        pvt2.update_bo_Standing(pi, 50.)
+        max_error = max(max_error, abs(pvt1.get_bo() - pvt2.get_bo()) / pvt1.get_bo())
+    cache = pvt2.get_cache()
+    print(f'PVT cache: {cache.get_hits()} hits, {cache.get_misses()} misses, {cache.get_size()} entries')
+    print(f'  max relative error in Bo = {max_error:.3g}')
+    assert cache.get_hits() > 0 and max_error < 1e-5, 'PVT cache misses or gives a Bo too far from the correlation'
+
+def array_test():
+    pvt1 = pvt.PVT()
+    pvt1.set_api(25.)
+    pvt1.set_dg(0.8)
+    pvt1.set_gor(80.)
+
+    p = np.linspace(10., 300., 50)
+    t = 80.
+    out = pvt1.calculate_Standing_array(p, t)
+
+    max_error = 0.
+    pvt1.set_t(t)
+    for pi, bo in zip(p, out['bo']):
+        pvt1.set_p(pi)
+        pvt1.calculate_rs_Standing()
+        pvt1.calculate_p_bubble_Standing()
+        pvt1.calculate_co_bubble_Standing()
+        pvt1.calculate_bo_bubble_Standing()
+        pvt1.calculate_bo_Standing()
+        max_error = max(max_error, abs(pvt1.get_bo() - bo) / pvt1.get_bo())
+    print(f'Array PVT: max relative error in Bo = {max_error:.3g}')
+    assert max_error < 1e-12, 'vectorized Standing Bo differs from the scalar calculation'
+
+    _ = plt.figure()
+    plt.plot(p, out['bo'])
+    plt.grid()
+    plt.xlabel('p [bar]')
+    plt.ylabel('Bo [m3/m3]')
+    plt.title('Bo Using Vectorized Standing Correlation')
+    save_plot(plt,'bo_array')
+
+def table_test():
+    pvt1 = pvt.PVT()
+    pvt1.set_api(15.)
+    pvt1.set_dg(0.6)
+    pvt1.set_gor(20.)
+
+    for method in ['linear', 'pchip']:
+        table = pvt.PVTTable()
+        table.set_method(method)
+        table.build(pvt1, 1., 400., 200, 20., 80., 13)
+        max_errors = {name: table.get_max_error(pvt1, name) for name in ['bo', 'uo', 'z']}
+        errors = ', '.join([f'{name} = {error:.2e}' for name, error in max_errors.items()])
+        print(f'PVT table ({method}): max relative error {errors}')
+        assert max_errors['bo'] < 1e-3 and max_errors['z'] < 1e-3 and max_errors['uo'] < 0.05, f'PVT table ({method}) is too far from the correlations'
+
+    table.save(path+'/plots/pvt/pvt_table.npz')
+    table2 = pvt.PVTTable()
+    table2.load(path+'/plots/pvt/pvt_table.npz')
+    table2.set_method('pchip')
+    pvt1.update_bo_Standing(150., 50.)
+    bo = pvt1.get_bo()
+    pvt1.set_table(table2)
+    pvt1.update_bo_Standing(150., 50.)
+    print(f'  Bo from loaded table at 150 bar, 50 oC = {pvt1.get_bo():.6f} (correlation {bo:.6f})')
+    assert abs(pvt1.get_bo() - bo) < 1e-3 * bo, 'Bo from the loaded table is too far from the correlation'
+
 if __name__ == "__main__":
     # rs_test()
     # pb_test()
@@ -427,4 +504,7 @@ if __name__ == "__main__":
     # uo_test()
     # rhoo_test()
     # rhog_test()
+    cache_test()
+    array_test()
+    table_test()
     u_emulssion_test()
\ No newline at end of file
@@ -1,5 +1,9 @@
 import os
+import time
+import tempfile
+import numpy as np
 from context import reservoir
+from context import relative_permeability
 import matplotlib.pyplot as plt
 
 debug_mode = True
@@ -18,7 +22,7 @@ def simple_plot(x,y, x_label, y_label, title, file):
     plt.title(title)
     save_plot(plt,file)
 
-def simple_2D_2f(i, j):
+def define_simple_2D_2f(i, j):
     model = reservoir.Simple2D_OW()
     model.set_p_init(340.)
     model.set_k(1000.)
@@ -57,7 +61,10 @@ def simple_2D_2f(i, j):
     model.set_max_dt(10.)
     model.set_min_dt(0.1)
     model.set_first_cell_dsw(0.05)
+    return model
 
+def simple_2D_2f(i, j):
+    model = define_simple_2D_2f(i, j)
     # model.initialize()
     model.run_simulation(0.10)
 
@@ -122,6 +129,485 @@ def simple_2D_2f(i, j):
         plt.title('Sw Map')
         save_plot(plt,'sim_final_sw')
 
+def compare_runs(i, j, t_end, configurations, tolerances={}):
+    results = {}
+    for name, configure in configurations.items():
+        model = define_simple_2D_2f(i, j)
+        model.set_t_end(t_end)
+        configure(model)
+        start = time.time()
+        model.run_simulation(0.10)
+        results[name] = model
+        print(f'  {name:12s}: {time.time() - start:.2f} s, {len(model.get_t())} time-steps')
+    names = list(results.keys())
+    ref = results[names[0]]
+    for name in names[1:]:
+        dsw = np.max(np.abs(ref.get_sw_map(-1) - results[name].get_sw_map(-1)))
+        dpr = np.max(np.abs(ref.get_pr_map(-1) - results[name].get_pr_map(-1)))
+        print(f'  {name} vs {names[0]}: max |dSw| = {dsw:.3g}, max |dPr| = {dpr:.3g} bar')
+        if name in tolerances:
+            max_dsw, max_dpr = tolerances[name]
+            assert dsw <= max_dsw and dpr <= max_dpr, f'{name} differs from {names[0]} by more than max |dSw| = {max_dsw}, max |dPr| = {max_dpr} bar'
+    return results
+
+def build_per_cell(model, x, dt):
+    # cell by cell assembly of the original 2D model (one layer, legacy wells) as reference for build_k and build_f
+    ni = model.get_ni()
+    nj = model.get_nj()
+    hk = model.get_hk()
+    bo_uo = model.get_bo() * model.get_uo()
+    bw_uw = model.get_bw() * model.get_uw()
+    di = model._di_mat[:, :, 0]
+    dj = model._dj_mat[:, :, 0]
+    perm = model._k_mat[:, :, 0]
+    phi = model._phi_mat[:, :, 0]
+    x_last = model._x_last
+    k = np.zeros((model._nvars, model._nvars))
+    f = np.zeros(model._nvars)
+    for j in range(nj):
+        for i in range(ni):
+            p = i + j * ni
+            for i2, j2 in [(i-1, j), (i+1, j), (i, j-1), (i, j+1)]:
+                if i2 < 0 or i2 >= ni or j2 < 0 or j2 >= nj:
+                    continue
+                p2 = i2 + j2 * ni
+                k_face = 2 * perm[i, j] * perm[i2, j2] / (perm[i, j] + perm[i2, j2])
+                if i == i2:
+                    tr = k_face * di[i, j] * hk / dj[i, j]
+                else:
+                    tr = k_face * dj[i, j] * hk / di[i, j]
+                sw = x[2*p+1] if x[2*p] > x[2*p2] else x[2*p2+1]
+                tro = reservoir.unit_conv * tr * model.kr.get_krow_2f(sw) / bo_uo
+                trw = reservoir.unit_conv * tr * model.kr.get_krw_2f(sw) / bw_uw
+                k[2*p, 2*p] -= tro
+                k[2*p+1, 2*p] -= trw
+                k[2*p, 2*p2] = tro
+                k[2*p+1, 2*p2] = trw
+            vp_dt = di[i, j] * dj[i, j] * hk * phi[i, j] / dt
+            k[2*p, 2*p+1] = vp_dt / model.get_bo()
+            k[2*p+1, 2*p+1] = -1. * vp_dt / model.get_bw()
+            f[2*p] = vp_dt / model.get_bo() * x_last[2*p+1]
+            f[2*p+1] = -1. * vp_dt / model.get_bw() * x_last[2*p+1]
+
+    a = dj[-1, -1] / di[-1, -1]
+    ro = di[-1, -1] * np.exp(-(a*np.pi - np.log(a))/(1. + a*a))
+    wi = reservoir.unit_conv * 2. * np.pi * perm[-1, -1] * hk / (np.log(ro/model.get_rw()) + model.get_skin())
+    k[-2, -2] -= wi * model.kr.get_krow_2f(x[-1]) / bo_uo
+    k[-1, -2] -= wi * model.kr.get_krw_2f(x[-1]) / bw_uw
+    f[1] -= model.get_qwi()
+    f[-2] -= wi * model.kr.get_krow_2f(x_last[-1]) / bo_uo * model.get_pwf()
+    f[-1] -= wi * model.kr.get_krw_2f(x_last[-1]) / bw_uw * model.get_pwf()
+    return k, f
+
+def assembly_test(i, j, dt=5.):
+    rng = np.random.default_rng(0)
+    model = define_simple_2D_2f(i, j)
+    model.set_hj(1.5 * model.get_hj())
+    model.set_k_array(rng.lognormal(np.log(1000.), 0.5, (i, j)))
+    model.set_phi_array(rng.uniform(0.12, 0.18, (i, j)))
+    model.initialize()
+    model.start_simulation()
+    x = model._x_last.copy()
+    x[0::2] += rng.uniform(-20., 20., i * j)
+    x[1::2] = rng.uniform(0.2, 0.84, i * j)
+    model._x_last[1::2] = rng.uniform(0.2, 0.84, i * j)
+    k_ref, f_ref = build_per_cell(model, x, dt)
+    for method in ['dense', 'sparse']:
+        model.linear_solver.set_method(method)
+        k = model.build_k(x, dt)
+        if model.linear_solver.is_sparse():
+            k = k.toarray()
+        f = model.build_f(dt)
+        print(f'  {method:6s}: max |K - K per cell| = {np.max(np.abs(k - k_ref)):.2g}, max |f - f per cell| = {np.max(np.abs(f - f_ref)):.2g}')
+        assert np.allclose(k, k_ref, rtol=1e-12, atol=0.), f'{method} K differs from the cell by cell assembly'
+        assert np.allclose(f, f_ref, rtol=1e-12, atol=0.), f'{method} f differs from the cell by cell assembly'
+
+def face_cache_test(i, j):
+    rng = np.random.default_rng(0)
+    model = define_simple_2D_2f(i, j)
+    model.set_hj(1.5 * model.get_hj())
+    model.set_k_array(rng.lognormal(np.log(1000.), 0.5, (i, j)))
+    model.set_phi_array(rng.uniform(0.12, 0.18, (i, j)))
+    model.initialize()
+    hk = model.get_hk()
+    di = model._di_mat[:, :, 0]
+    dj = model._dj_mat[:, :, 0]
+    perm = model._k_mat[:, :, 0]
+    tr_ref = np.zeros(model._face_c1.size)
+    for n, (c1, c2) in enumerate(zip(model._face_c1, model._face_c2)):
+        i1, j1 = c1 % i, c1 // i
+        i2, j2 = c2 % i, c2 // i
+        k_face = 2 * perm[i1, j1] * perm[i2, j2] / (perm[i1, j1] + perm[i2, j2])
+        if i1 == i2:
+            tr_ref[n] = reservoir.unit_conv * k_face * di[i1, j1] * hk / dj[i1, j1]
+        else:
+            tr_ref[n] = reservoir.unit_conv * k_face * dj[i1, j1] * hk / di[i1, j1]
+    pv_ref = np.array([di[c % i, c // i] * dj[c % i, c // i] * hk * model._phi_mat[c % i, c // i, 0] for c in range(i * j)])
+    print(f'  {model._face_c1.size} faces: max |Tr - Tr per face| = {np.max(np.abs(model._face_tr - tr_ref)):.2g}, '
+          f'max |Vp - Vp per cell| = {np.max(np.abs(model._pore_volume - pv_ref)):.2g}')
+    assert model._face_c1.size == (i - 1) * j + i * (j - 1), 'wrong number of faces'
+    assert np.allclose(model._face_tr, tr_ref, rtol=1e-12, atol=0.), 'cached transmissibilities differ from the per face calculation'
+    assert np.allclose(model._pore_volume, pv_ref, rtol=1e-12, atol=0.), 'cached pore volumes differ from the per cell calculation'
+
+def linear_solver_test(i, j, t_end=30.):
+    compare_runs(i, j, t_end, {
+        'dense': lambda model: model.linear_solver.set_method('dense'),
+        'sparse': lambda model: model.linear_solver.set_method('sparse'),
+        }, {'sparse': (1e-8, 1e-5)})
+
+def factorization_reuse_test(i, j, t_end=30.):
+    results = compare_runs(i, j, t_end, {
+        'sparse': lambda model: model.linear_solver.set_method('sparse'),
+        'sparse reuse': lambda model: (model.linear_solver.set_method('sparse'),
+                                       model.linear_solver.set_reuse_factorization(True)),
+        }, {'sparse reuse': (1e-8, 1e-5)})
+    solver = results['sparse reuse'].linear_solver
+    print(f'  Factorizations: {solver.get_n_factorizations()}, avoided: {solver.get_n_reused()}')
+    assert solver.get_n_reused() > 0, 'no factorization was reused'
+
+def krylov_solver_test(i, j, t_end=30.):
+    results = compare_runs(i, j, t_end, {
+        'sparse': lambda model: model.linear_solver.set_method('sparse'),
+        'gmres ilu': lambda model: (model.linear_solver.set_method('gmres'),
+                                    model.linear_solver.set_preconditioner('ilu')),
+        'bicgstab cpr': lambda model: (model.linear_solver.set_method('bicgstab'),
+                                       model.linear_solver.set_preconditioner('cpr')),
+        'gmres 3 iter': lambda model: (model.linear_solver.set_method('gmres'),
+                                       model.linear_solver.set_max_krylov_iter(3)),
+        }, {'gmres ilu': (1e-8, 1e-5), 'bicgstab cpr': (1e-8, 1e-5), 'gmres 3 iter': (1e-3, 5.)})
+    for name in ['gmres ilu', 'bicgstab cpr']:
+        print(f'  {name}: {results[name].linear_solver.get_n_linear_iter()} iterations, max {max(results[name].get_linear_iter())} in a time-step')
+    # failed linear solves cut the time-step, so the result stays close to the converged solvers
+    print(f'  gmres 3 iter: {results["gmres 3 iter"].linear_solver.get_n_failed()} failed linear solves')
+    assert results['gmres 3 iter'].linear_solver.get_n_failed() > 0, 'the 3 iteration limit never failed a linear solve'
+
+def ordering_test(i, j, t_end=30.):
+    results = compare_runs(i, j, t_end, {
+        'natural': lambda model: (model.linear_solver.set_method('banded'),
+                                  model.linear_solver.set_ordering('natural')),
+        'rcm': lambda model: (model.linear_solver.set_method('banded'),
+                              model.linear_solver.set_ordering('rcm')),
+        'grid': lambda model: (model.linear_solver.set_method('banded'),
+                               model.linear_solver.set_ordering('grid')),
+        }, {'rcm': (1e-8, 1e-5), 'grid': (1e-8, 1e-5)})
+    for name, model in results.items():
+        print(f'  {name}: bandwidth = {model.linear_solver.get_bandwidth()}')
+
+def nonlinear_solver_test(i, j, t_end=365.25):
+    compare_runs(i, j, t_end, {
+        'picard': lambda model: model.set_nonlinear_solver('picard'),
+        'newton': lambda model: model.set_nonlinear_solver('newton'),
+        }, {'newton': (0.01, 5.)})
+
+def formulation_test(i, j, t_end=365.25):
+    compare_runs(i, j, t_end, {
+        'implicit': lambda model: model.set_formulation('implicit'),
+        'impes': lambda model: model.set_formulation('impes'),
+        }, {'impes': (0.03, 15.)})
+
+def step_controller_test(i, j, t_end=365.25):
+    results = compare_runs(i, j, t_end, {
+        'simple': lambda model: model.step_controller.set_method('simple'),
+        'pi': lambda model: model.step_controller.set_method('pi'),
+        }, {'pi': (0.005, 5.)})
+    for name, model in results.items():
+        print(f'  {name}: {model.step_controller.get_n_accepted()} accepted, {model.step_controller.get_n_rejected()} rejected time-steps')
+    # a second run of the same model starts from a fresh controller and repeats the time-steps
+    model = results['pi']
+    counts = (model.step_controller.get_n_accepted(), model.step_controller.get_n_rejected())
+    t = list(model.get_t())
+    model.reset_sim()
+    model.run_simulation(0.10)
+    assert (model.step_controller.get_n_accepted(), model.step_controller.get_n_rejected()) == counts
+    assert list(model.get_t()) == t
+    print('  pi rerun: same time-steps (ok)')
+
+def define_five_spot(model):
+    n = model.get_ni()
+    for name, (i, j) in {'INJ1': (0, 0), 'INJ2': (n-1, 0), 'INJ3': (0, n-1), 'INJ4': (n-1, n-1)}.items():
+        well = reservoir.Well(name)
+        well.set_location(i, j)
+        well.set_type('injector')
+        well.set_control('rate')
+        well.set_value(250.)
+        well.set_rw(4 * 2.54 / 100.)
+        model.add_well(well)
+    well = reservoir.Well('PROD1')
+    well.set_location(n//2, n//2)
+    well.set_type('producer')
+    well.set_control('bhp')
+    well.set_value(300.)
+    well.set_rw(4 * 2.54 / 100.)
+    model.add_well(well)
+    well = reservoir.Well('PROD2')
+    well.set_location(n//2, 0)
+    well.set_type('producer')
+    well.set_control('rate')
+    well.set_value(150.)
+    well.set_rw(4 * 2.54 / 100.)
+    model.add_well(well)
+
+def multi_well_test(i, j, t_end=365.25):
+    results = compare_runs(i, j, t_end, {
+        'picard': lambda model: define_five_spot(model),
+        'newton': lambda model: (define_five_spot(model), model.set_nonlinear_solver('newton')),
+        'impes': lambda model: (define_five_spot(model), model.set_formulation('impes')),
+        }, {'newton': (0.01, 2.), 'impes': (0.015, 10.)})
+    for name, model in results.items():
+        print(f'  {name}:')
+        q_res = 0.
+        for well in model.get_wells():
+            qo, qw = model.get_last_well_rates(well.get_name())
+            bhp = model.get_well_bhp(well.get_name())[-1]
+            print(f'    {well.get_name():6s}: Qo = {qo:8.2f} m3/d, Qw = {qw:8.2f} m3/d, BHP = {bhp:6.1f} bar')
+            if well.is_producer():
+                q_res += model.get_bo() * qo + model.get_bw() * qw
+            else:
+                q_res -= model.get_bw() * qw
+        print(f'    Reservoir volume balance: {q_res:.3g} m3/d')
+
+def well_copy_test(i, j, dt=5.):
+    model = define_simple_2D_2f(i, j)
+    define_five_spot(model)
+    prod = model.get_well('PROD1')
+    model.initialize()
+    model.start_simulation()
+    model.try_pwf(250., dt)
+    model.try_pwf_response(260., dt)
+    assert prod.get_value() == 300., 'trials changed the well given by the user'
+    model.reset_sim()
+    model.initialize()
+    model.start_simulation()
+    assert model.get_pwf() == 300., 'a new run does not start from the well value given by the user'
+
+    model = define_simple_2D_2f(i, j)
+    model.reset_wells()
+    for name, (wi, wj) in {'INJ1': (0, 0), 'INJ2': (i-1, j-1)}.items():
+        well = reservoir.Well(name)
+        well.set_location(wi, wj)
+        well.set_type('injector')
+        well.set_control('rate')
+        well.set_value(250.)
+        well.set_rw(4 * 2.54 / 100.)
+        model.add_well(well)
+    model.initialize()
+    model.start_simulation()
+    try:
+        model.get_well_qo()
+    except NameError as e:
+        print(f'  No producer: {e}')
+    else:
+        raise AssertionError('get_well_qo() without a producer did not raise NameError')
+    print('  User wells kept their values (ok)')
+
+def define_layers(model):
+    model.set_nk(4)
+    model.set_k_layers([1500., 800., 300., 1000.])
+    model.set_phi_layers([0.20, 0.15, 0.12, 0.18])
+    model.set_kv_kh(0.1)
+
+def layered_test(i, j, t_end=365.25):
+    results = compare_runs(i, j, t_end, {
+        'no gravity': lambda model: define_layers(model),
+        'gravity': lambda model: (define_layers(model), model.set_rho_o(850.), model.set_rho_w(1050.)),
+        })
+    for name, model in results.items():
+        qo, qw = model.get_last_well_rates()
+        sw = [np.mean(model.get_sw_map(-1, k)) for k in range(model.get_nk())]
+        print(f'  {name}: Qo = {qo:.2f} m3/d, Qw = {qw:.2f} m3/d, mean Sw per layer = {np.round(sw, 4)}')
+
+def property_file_test(i, j, t_end=365.25):
+    folder = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    np.save(os.path.join(folder, 'k.npy'), rng.lognormal(np.log(1000.), 0.5, (i, j)))
+    rng.uniform(0.12, 0.18, i * j).tofile(os.path.join(folder, 'phi.bin'))
+
+    def load(model):
+        start = time.time()
+        model.load_property('k', os.path.join(folder, 'k.npy'))
+        model.load_property('phi', os.path.join(folder, 'phi.bin'))
+        print(f'  Properties loaded in {1000 * (time.time() - start):.2f} ms')
+
+    compare_runs(i, j, t_end, {
+        'homogeneous': lambda model: None,
+        'from files': load,
+        })
+
+def grid_change_test(i=4, j=3):
+    # properties given before the grid is complete are mapped with the grid of initialize()
+    folder = tempfile.mkdtemp()
+    k = np.random.default_rng(0).lognormal(np.log(1000.), 0.5, (i, j, 2))
+    k.ravel(order='F').tofile(os.path.join(folder, 'k.bin'))
+    model = define_simple_2D_2f(i, j)
+    model.load_property('k', os.path.join(folder, 'k.bin'))
+    model.set_nk(2)
+    model.initialize()
+    assert np.array_equal(model._k_mat, k), 'property loaded before set_nk() is mapped to the wrong cells'
+
+    model = define_simple_2D_2f(i, j)
+    model.set_phi_array(np.full(i * j, 0.2))
+    model.set_nk(2)
+    try:
+        model.initialize()
+    except ValueError as e:
+        print(f'  Flat array that no longer fits the grid: {e}')
+    else:
+        raise AssertionError('a flat array of the old grid size was accepted')
+    print('  Properties follow the grid at initialize() (ok)')
+
+def map_round_trip_test(i=6, j=4, t_end=30.):
+    # a map read with get_*_map() and loaded back with load_property() must land on the same cells
+    model = define_simple_2D_2f(i, j)
+    model.set_t_end(t_end)
+    model.set_k_array(np.random.default_rng(0).lognormal(np.log(1000.), 0.5, (i, j)))
+    model.run_simulation(0.10)
+    pr = model.get_pr_map(-1)
+    assert pr.shape == (i, j)
+    assert all(pr[ii, jj] == model.get_pr_cell(ii, jj)[-1] for ii in range(i) for jj in range(j)), 'map and get_pr_cell() disagree'
+    assert model.get_sw_map(0)[0, 0] == model.kr.sat.get_swi() + 0.05, 'first cell is not at [0, 0]'
+
+    file_name = os.path.join(tempfile.mkdtemp(), 'pr.npy')
+    np.save(file_name, pr)
+    copy = define_simple_2D_2f(i, j)
+    copy.load_property('k', file_name)
+    copy.initialize()
+    assert np.array_equal(copy._get_cell_values(copy._k_mat), model._x_history[-1][::2]), 'map does not round-trip through load_property()'
+    print(f'  {i}x{j} grid: pressure map round-trips through load_property() (ok)')
+
+def set_kr_table(model, n=101):
+    sw = np.linspace(0., 1., n)
+    table = relative_permeability.KrTable()
+    table.set_table(sw, model.kr.get_krw_2f_array(sw), model.kr.get_krow_2f_array(sw))
+    model.kr = table
+
+def kr_table_test(i, j, t_end=365.25):
+    compare_runs(i, j, t_end, {
+        'corey': lambda model: None,
+        'table': set_kr_table,
+        'table newton': lambda model: (set_kr_table(model),
+                                       model.set_nonlinear_solver('newton')),
+        }, {'table': (0.005, 5.), 'table newton': (0.01, 5.)})
+
+def define_realization(i, j, seed, t_end):
+    rng = np.random.default_rng(seed)
+    model = define_simple_2D_2f(i, j)
+    model.set_t_end(t_end)
+    model.set_k_array(rng.lognormal(np.log(1000.), 0.5, (i, j)))
+    model.set_phi_array(rng.uniform(0.12, 0.18, (i, j)))
+    model.kr.set_nw(rng.uniform(1.5, 3.))
+    return model
+
+def ensemble_test(i, j, n=50, t_end=365.25):
+    start = time.time()
+    qo_sequential = np.zeros(n)
+    for seed in range(n):
+        model = define_realization(i, j, seed, t_end)
+        model.run_simulation(0.10)
+        qo_sequential[seed] = model.get_well_qo()[-1]
+    t_sequential = time.time() - start
+
+    ensemble = reservoir.Ensemble()
+    for seed in range(n):
+        ensemble.add_model(define_realization(i, j, seed, t_end))
+    start = time.time()
+    ensemble.run_simulation(0.10)
+    t_ensemble = time.time() - start
+    qo = ensemble.get_well_qo()[:, -1]
+    print(f'  {n} models: sequential {t_sequential:.2f} s, ensemble {t_ensemble:.2f} s ({len(ensemble.get_t())} time-steps)')
+    print(f'  Final Qo: P10 = {np.percentile(qo, 10):.1f}, P50 = {np.percentile(qo, 50):.1f}, P90 = {np.percentile(qo, 90):.1f} m3/d')
+    dqo = np.max(np.abs(qo - qo_sequential) / qo_sequential)
+    print(f'  Max relative difference to the sequential runs: {dqo:.3g}')
+    # the models share the time-steps of the ensemble, so the rates differ by the time discretization only
+    assert dqo < 0.05, 'ensemble rates differ from the sequential runs'
+
+def define_bhp_pair(model, p_inj=400.):
+    # BHP injector and producer: unlike a rate injector, the rates follow the producer Pwf
+    n_i, n_j = model.get_ni(), model.get_nj()
+    for name, (i, j), well_type, value in [('INJ', (0, 0), 'injector', p_inj), ('PROD', (n_i-1, n_j-1), 'producer', model.get_pwf())]:
+        well = reservoir.Well(name)
+        well.set_location(i, j)
+        well.set_type(well_type)
+        well.set_control('bhp')
+        well.set_value(value)
+        well.set_rw(4 * 2.54 / 100.)
+        model.add_well(well)
+
+def well_response_test(i, j, dt=5., n_steps=20):
+    full = define_simple_2D_2f(i, j)
+    response = define_simple_2D_2f(i, j)
+    for model in [full, response]:
+        define_bhp_pair(model)
+        model.initialize()
+        model.start_simulation()
+        for _ in range(n_steps):
+            model.propose(model.get_pwf(), 10.)
+            model.commit()
+    pwf_base = 250.
+    qo_base, _ = response.try_pwf_response(pwf_base, dt)
+    x_base = response._x_current.copy()
+    k = response.build_k(x_base, dt)
+    errors = []
+    for pwf in [250., 251., 260., 270., 290., 310.]:
+        qo, qw = full.try_pwf(pwf, dt)
+        qo_r, qw_r = response.try_pwf_response(pwf, dt)
+        # the response is the frozen-mobility linear solve at this Pwf
+        x_linear = np.linalg.solve(k, response._build_rhs(dt, x_base))
+        assert np.allclose(response._x_current, x_linear, rtol=1e-9, atol=1e-9), f'response at {pwf} bar is not the linear solve'
+        dpr = np.max(np.abs(full._x_current[0::2] - response._x_current[0::2]))
+        dsw = np.max(np.abs(full._x_current[1::2] - response._x_current[1::2]))
+        errors.append(abs(qo - qo_r))
+        if pwf != pwf_base:
+            assert qo < qo_prev and qo_r < qo_r_prev, f'Qo does not decrease with Pwf at {pwf} bar'
+        qo_prev, qo_r_prev = qo, qo_r
+        print(f'Pwf = {pwf:.0f} bar: Qo = {qo:.3f} / {qo_r:.3f} m3/d, Qw = {qw:.3f} / {qw_r:.3f} m3/d (full / linear response), '
+              f'max |dPr| = {dpr:.3g} bar, max |dSw| = {dsw:.3g}')
+        if pwf == pwf_base:
+            # same state up to the fixed-point tolerance (0.01 on the norm of the update)
+            assert dpr < 0.01 and dsw < 1e-6, 'response differs from the full solve at the Pwf it was built from'
+    assert qo_base - qo > 0.1 * qo_base, 'Qo does not depend on Pwf'
+    # frozen mobilities: the error grows with the distance from the Pwf the response was built from
+    assert all(e1 < e2 for e1, e2 in zip(errors[1:], errors[2:])), 'the response error does not grow with the Pwf change'
+
+def get_committed_state(model):
+    return [model._x_last.copy(), np.array(model.get_t()), model._x_history.get_array().copy(), model._well_history.get_array().copy()]
+
+def assert_same_state(state1, state2, message):
+    for a, b in zip(state1, state2):
+        assert a.shape == b.shape and np.array_equal(a, b), message
+
+def transaction_test(i, j, dt=5., n_steps=10):
+    model = define_simple_2D_2f(i, j)
+    direct = define_simple_2D_2f(i, j)
+    for m in [model, direct]:
+        define_bhp_pair(m)
+        m.initialize()
+        m.start_simulation()
+    for _ in range(n_steps):
+        model.propose(model.get_pwf(), dt)
+        model.commit()
+        direct.solve_next_dt(dt)
+        direct.commit(dt)
+    assert_same_state(get_committed_state(model), get_committed_state(direct), 'proposed and committed steps differ from direct steps')
+
+    before = get_committed_state(model)
+    model.propose(260., dt)
+    model.rollback()
+    assert_same_state(before, get_committed_state(model), 'rollback changed the committed state')
+    assert np.array_equal(model._x_current, model._x_last) and model.get_proposed_dt() is None
+
+    rates = model.propose(280., dt)
+    state = model.snapshot()
+    rates_300 = model.propose(300., dt)
+    assert rates_300[0] < rates[0], 'Qo does not depend on Pwf'
+    model.restore(state)
+    model.commit()
+    direct.set_pwf(280.)
+    direct.solve_next_dt(dt)
+    direct.commit(dt)
+    assert_same_state(get_committed_state(model), get_committed_state(direct), 'restored and committed step differs from a direct step')
+    assert model.get_pwf() == direct.get_pwf() == 280.
+    print(f'Proposed at 280 bar: Qo = {rates[0]:.3f} m3/d, Qw = {rates[1]:.3f} m3/d; at 300 bar: Qo = {rates_300[0]:.3f} m3/d')
+    print(f'Committed: t = {model.get_t()[-1]:.1f} d, Qo = {model.get_well_qo()[-1]:.3f} m3/d, Qw = {model.get_well_qw()[-1]:.3f} m3/d, Pwf = {model.get_pwf():.1f} bar, same as a direct step (ok)')
 
 if __name__ == "__main__":
     for i in [5]: #[3, 5, 7, 9, 10]: #, 15, 20, 25, 30, 35, 40, 45, 50, 60, 70, 80, 90, 100]:
@@ -129,4 +615,39 @@ if __name__ == "__main__":
         # simple_2D_2f(i,1)
         print(f'i = {i}, j = {i}')
         simple_2D_2f(i,i)
+        print('Assembly:')
+        assembly_test(i, i + 2)
+        print('Face cache:')
+        face_cache_test(i, i + 2)
+        print('Linear solvers:')
+        linear_solver_test(i, i)
+        print('Factorization reuse:')
+        factorization_reuse_test(i, i)
+        print('Krylov solvers:')
+        krylov_solver_test(i, i)
+        print('Ordering:')
+        ordering_test(i, i)
+        print('Nonlinear solvers:')
+        nonlinear_solver_test(i, i)
+        print('Formulations:')
+        formulation_test(i, i)
+        print('Time-step controllers:')
+        step_controller_test(i, i)
+        print('Multiple wells:')
+        multi_well_test(i, i)
+        well_copy_test(i, i)
+        print('Layers:')
+        layered_test(i, i)
+        print('Property files:')
+        property_file_test(i, i)
+        grid_change_test()
+        map_round_trip_test()
+        print('Kr table:')
+        kr_table_test(i, i)
+        print('Ensemble:')
+        ensemble_test(i, i)
+        print('Well response:')
+        well_response_test(i, i)
+        print('Transactions:')
+        transaction_test(i, i)
     pass